@@ -0,0 +1,203 @@
+# Usage: python3 benchmarks/bench_firewiki.py [--scales 10,1000,100000] [--output results.json]
+import os
+import sys
+import io
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import statistics
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import firewiki
+
+WORDS = ['fire', 'wiki', 'terminal', 'macro', 'version', 'render', 'page', 'community', 'index', 'tag',
+         'export', 'shell', 'markdown', 'history', 'restore', 'search', 'cache', 'journal', 'blob', 'delta']
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS and kilobytes elsewhere
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+def synthetic_page(rng, lines):
+    out = []
+    in_code = False
+    for i in range(lines):
+        kind = rng.random()
+        words = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 14)))
+        if kind < 0.03:
+            out.append('```')
+            in_code = not in_code
+        elif in_code:
+            out.append(f'    {words}')
+        elif kind < 0.08:
+            out.append(f'# {words}')
+        elif kind < 0.13:
+            out.append(f'## {words}')
+        elif kind < 0.25:
+            out.append(f'- {words}')
+        elif kind < 0.30:
+            out.append(f'> {words}')
+        elif kind < 0.35:
+            out.append(f'**{words}** and `code {i}`')
+        elif kind < 0.37:
+            out.append(f'#tag {rng.choice(WORDS)}')
+        else:
+            out.append(f'*{words}* {words}')
+    if in_code:
+        out.append('```')
+    return '\n'.join(out)
+
+def generate_community(name, pages, rng, page_lines=40):
+    firewiki.save_community_metadata(name, 'Benchmark', 'Synthetic community', '')
+    comm = f'.{name}'
+    for i in range(pages):
+        with open(os.path.join(comm, f'page{i:06d}.md'), 'w') as f:
+            f.write(synthetic_page(rng, page_lines))
+    firewiki.save_edit_macros(comm, {'bench': [':insert appended by benchmark', ':replace 1 # replaced title']})
+    return comm
+
+def build_history(comm, page_file, depth, rng):
+    content = synthetic_page(rng, 200)
+    with open(os.path.join(comm, page_file), 'w') as f:
+        f.write(content)
+    for _ in range(depth):
+        lines = content.split('\n')
+        lines[rng.randrange(len(lines))] = ' '.join(rng.choice(WORDS) for _ in range(8))
+        content = '\n'.join(lines)
+        firewiki.create_version(comm, page_file, content, 'edit_post')
+    with open(os.path.join(comm, page_file), 'w') as f:
+        f.write(content)
+
+def summarize(samples):
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    return {
+        'runs': len(ordered),
+        'min_ms': ordered[0] * 1000,
+        'mean_ms': statistics.fmean(ordered) * 1000,
+        'p50_ms': percentile(50) * 1000,
+        'p90_ms': percentile(90) * 1000,
+        'p99_ms': percentile(99) * 1000,
+        'max_ms': ordered[-1] * 1000,
+    }
+
+def measure(func, repeat, setup=None):
+    samples = []
+    rss_before = peak_rss_kb()
+    for i in range(repeat):
+        arg = setup(i) if setup else None
+        # Operations like replay_macro and export_posix report to stdout
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func(arg) if setup else func()
+            samples.append(time.perf_counter() - start)
+    result = summarize(samples)
+    # ru_maxrss only ever grows over the whole process, so report how much these runs raised it
+    result['peak_rss_growth_kb'] = None if rss_before is None else peak_rss_kb() - rss_before
+    # One more untimed run under tracemalloc gives the operation's own peak Python allocation
+    arg = setup(repeat) if setup else None
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            func(arg) if setup else func()
+        result['peak_alloc_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+    return result
+
+def run_scale(pages, args, rng):
+    comm = generate_community(f'Bench{pages}', pages, rng)
+    sample_pages = firewiki.scan_pages(comm)
+    results = {}
+
+    results['create_version'] = measure(
+        lambda i: firewiki.create_version(comm, 'versioned.md', f'{synthetic_page(rng, 20)}\nrevision {i}', 'edit_post'),
+        args.repeat, setup=lambda i: i)
+
+    build_history(comm, 'deep.md', args.history_depth, rng)
+    large = synthetic_page(rng, args.large_page_kb * 1024 // 60)
+    with open(os.path.join(comm, 'large.md'), 'w') as f:
+        f.write(large)
+    normal = synthetic_page(rng, 200)
+
+    results['render_markdown'] = measure(lambda: firewiki.render_markdown(normal), args.repeat)
+    results['render_markdown_large'] = measure(lambda: firewiki.render_markdown(large), max(3, args.repeat // 10))
+
+    def list_cold():
+        firewiki.catalog_connections.clear()
+        if os.path.exists(firewiki.CATALOG_FILE):
+            os.remove(firewiki.CATALOG_FILE)
+        firewiki.list_pages(comm)
+
+    results['list_pages_cold'] = measure(list_cold, max(3, args.repeat // 10))
+    results['list_pages'] = measure(lambda: firewiki.list_pages(comm), args.repeat)
+    results['get_page_info'] = measure(lambda i: firewiki.get_page_info(comm, i), args.repeat,
+                                       setup=lambda i: rng.choice(sample_pages))
+
+    history = firewiki.load_page_versions(comm, 'deep.md')
+    results['restore_version'] = measure(lambda v: firewiki.restore_page(comm, 'deep.md', v), args.repeat,
+                                         setup=lambda i: rng.choice(history))
+    results['replay_macro'] = measure(lambda p: firewiki.replay_macro(comm, 'bench', p), args.repeat,
+                                      setup=lambda i: rng.choice(sample_pages))
+    results['export_posix'] = measure(lambda: firewiki.export_posix(comm), max(3, args.repeat // 10))
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time FireWiki hot paths on synthetic communities')
+    parser.add_argument('--scales', default='10,1000', help='comma-separated page counts, e.g. 10,1000,100000')
+    parser.add_argument('--history-depth', type=int, default=500)
+    parser.add_argument('--large-page-kb', type=int, default=2048)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', help='directory to generate communities in (default: a temporary directory)')
+    parser.add_argument('--output', help='write JSON results here instead of stdout')
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='firewiki-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'history_depth': args.history_depth,
+        'large_page_kb': args.large_page_kb,
+        'scales': {},
+    }
+    try:
+        os.chdir(workdir)
+        for pages in [int(x) for x in args.scales.split(',') if x]:
+            print(f'Benchmarking {pages} pages...', file=sys.stderr)
+            report['scales'][str(pages)] = run_scale(pages, args, rng)
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -1,41 +1,374 @@
 import os
 import sys
+import io
 import shutil
 import json
 import hashlib
+import zlib
+import struct
+import mmap
+import difflib
+import bisect
+from collections import OrderedDict
+import re
+import math
+import time
+import argparse
+import subprocess
+import multiprocessing
+import importlib
+import importlib.util
+import shlex
+import tarfile
+import builtins
+import functools
+import cProfile
+import contextlib
+import threading
+import html
+import asyncio
+from http import HTTPStatus
+from urllib.parse import urlsplit, unquote, parse_qs, quote
+import fnmatch
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
 import readchar
-
-macros = {
-    'hello': lambda: print("Hello from macro!"),
-    'date': lambda: print("This is a simple macro example.")
-}
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 def ansi(text, code='0'):
     return f'\033[{code}m{text}\033[0m'
 
 def clear():
-    os.system('clear' if os.name == 'posix' else 'cls')
+    if os.name == 'posix':
+        print('\033[2J\033[H', end='', flush=True)
+    else:
+        os.system('cls')
 
 def input_optional(prompt):
     val = input(prompt + ' (optional): ')
     return val.strip() if val.strip() else None
 
+METRICS_ENABLED = os.environ.get('FIREWIKI_METRICS', '') not in ('', '0')
+METRICS_FILE = os.environ.get('FIREWIKI_METRICS_FILE', '.firewiki_metrics.jsonl')
+METRICS_MAX_BYTES = 1024 * 1024
+METRICS_BACKUPS = 3
+PROFILE_THRESHOLD_MS = float(os.environ.get('FIREWIKI_PROFILE_MS', '0') or 0)
+PROFILE_DIR = '.firewiki_profiles'
+metrics_stack = []
+
+class MeteredFile:
+    def __init__(self, f):
+        self._f = f
+
+    def _count(self, key, data):
+        for frame in metrics_stack:
+            frame[key] += len(data)
+        return data
+
+    def read(self, *args):
+        return self._count('bytes_read', self._f.read(*args))
+
+    def readline(self, *args):
+        return self._count('bytes_read', self._f.readline(*args))
+
+    def write(self, data):
+        self._count('bytes_written', data)
+        return self._f.write(data)
+
+    def __iter__(self):
+        for line in self._f:
+            yield self._count('bytes_read', line)
+
+    def __enter__(self):
+        self._f.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._f.__exit__(*exc)
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+def metered_open(*args, **kwargs):
+    for frame in metrics_stack:
+        frame['opens'] += 1
+    return MeteredFile(builtins.open(*args, **kwargs))
+
+def enable_metrics():
+    global METRICS_ENABLED
+    METRICS_ENABLED = True
+    # Shadows the builtin for this module only, so the disabled path costs nothing
+    globals()['open'] = metered_open
+
+def write_metrics_record(record):
+    if os.path.exists(METRICS_FILE) and os.path.getsize(METRICS_FILE) > METRICS_MAX_BYTES:
+        for i in range(METRICS_BACKUPS - 1, 0, -1):
+            if os.path.exists(f'{METRICS_FILE}.{i}'):
+                os.replace(f'{METRICS_FILE}.{i}', f'{METRICS_FILE}.{i+1}')
+        os.replace(METRICS_FILE, f'{METRICS_FILE}.1')
+    with builtins.open(METRICS_FILE, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+def instrumented(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not METRICS_ENABLED:
+            return func(*args, **kwargs)
+        frame = {'bytes_read': 0, 'bytes_written': 0, 'opens': 0}
+        profiler = cProfile.Profile() if PROFILE_THRESHOLD_MS and not metrics_stack else None
+        metrics_stack.append(frame)
+        start = time.perf_counter()
+        try:
+            if profiler:
+                return profiler.runcall(func, *args, **kwargs)
+            return func(*args, **kwargs)
+        finally:
+            wall_ms = (time.perf_counter() - start) * 1000
+            metrics_stack.pop()
+            record = dict(frame, op=func.__name__, ts=time.time(), wall_ms=round(wall_ms, 3), depth=len(metrics_stack))
+            if profiler and wall_ms >= PROFILE_THRESHOLD_MS:
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+                record['profile'] = os.path.join(PROFILE_DIR, f'{func.__name__}_{time.time_ns()}.prof')
+                profiler.dump_stats(record['profile'])
+            write_metrics_record(record)
+    return wrapper
+
+def load_metrics():
+    records = []
+    for path in [f'{METRICS_FILE}.{i}' for i in range(METRICS_BACKUPS, 0, -1)] + [METRICS_FILE]:
+        if os.path.exists(path):
+            with builtins.open(path) as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue
+    return records
+
+def metrics_summary():
+    totals = {}
+    for record in load_metrics():
+        totals.setdefault(record['op'], []).append(record)
+    if not totals:
+        print("No metrics recorded. Set FIREWIKI_METRICS=1 or pass --metrics.")
+        return
+    print(f"{'operation':<24}{'calls':>7}{'total ms':>12}{'mean ms':>10}{'p95 ms':>10}{'read':>12}{'written':>12}{'opens':>8}")
+    for op, records in sorted(totals.items(), key=lambda item: -sum(r['wall_ms'] for r in item[1])):
+        times = sorted(r['wall_ms'] for r in records)
+        total = sum(times)
+        p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+        print(f"{op:<24}{len(records):>7}{total:>12.1f}{total / len(records):>10.2f}{p95:>10.2f}"
+              f"{sum(r['bytes_read'] for r in records):>12}{sum(r['bytes_written'] for r in records):>12}"
+              f"{sum(r['opens'] for r in records):>8}")
+
+DURABILITY = os.environ.get('FIREWIKI_DURABILITY', 'fsync')
+durability_batches = []
+
+def sync_dir(path):
+    if os.name == 'posix':
+        fd = os.open(path or '.', os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def make_durable(f, path, new_entry=False):
+    # 'fsync' syncs every write, 'batch' defers to the enclosing durability_batch, 'none' leaves it to the OS
+    if DURABILITY == 'none':
+        return
+    f.flush()
+    directory = os.path.dirname(path)
+    if DURABILITY == 'batch' and durability_batches:
+        durability_batches[-1]['files'].add(path)
+        if new_entry:
+            durability_batches[-1]['dirs'].add(directory)
+        return
+    os.fsync(f.fileno())
+    if new_entry:
+        sync_dir(directory)
+
+@contextlib.contextmanager
+def durability_batch():
+    pending = {'files': set(), 'dirs': set()}
+    durability_batches.append(pending)
+    try:
+        yield
+    finally:
+        durability_batches.pop()
+        if durability_batches:
+            durability_batches[-1]['files'] |= pending['files']
+            durability_batches[-1]['dirs'] |= pending['dirs']
+        else:
+            for path in pending['files']:
+                if os.path.exists(path):
+                    fd = os.open(path, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+            for directory in pending['dirs']:
+                sync_dir(directory)
+
+@contextlib.contextmanager
+def atomic_open(path, mode='w', durable=True):
+    # Writes go to a temporary file that replaces the target only once complete
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+            if durable:
+                make_durable(f, path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if durable and DURABILITY != 'none':
+        if DURABILITY == 'batch' and durability_batches:
+            durability_batches[-1]['dirs'].add(os.path.dirname(path))
+        else:
+            sync_dir(os.path.dirname(path))
+
+def atomic_write(path, data, durable=True):
+    with atomic_open(path, 'wb' if isinstance(data, (bytes, bytearray)) else 'w', durable) as f:
+        f.write(data)
+
+def append_durable(path, data):
+    new_entry = not os.path.exists(path)
+    with open(path, 'ab' if isinstance(data, (bytes, bytearray)) else 'a') as f:
+        offset = f.tell()
+        f.write(data)
+        make_durable(f, path, new_entry)
+    return offset
+
+lock_registry = {}
+lock_registry_guard = threading.Lock()
+
+@contextlib.contextmanager
+def file_lock(path):
+    # Re-entrant within a process (threads share an RLock), exclusive across processes via flock
+    with lock_registry_guard:
+        entry = lock_registry.setdefault(path, [threading.RLock(), None, 0, None])
+    with entry[0]:
+        if entry[2] == 0:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            entry[1] = builtins.open(path, 'a+')
+            if fcntl:
+                fcntl.flock(entry[1].fileno(), fcntl.LOCK_EX)
+            entry[3] = threading.get_ident()
+        entry[2] += 1
+        try:
+            yield
+        finally:
+            entry[2] -= 1
+            if entry[2] == 0:
+                entry[3] = None
+                if fcntl:
+                    fcntl.flock(entry[1].fileno(), fcntl.LOCK_UN)
+                entry[1].close()
+                entry[1] = None
+
+@contextlib.contextmanager
+def shared_file_lock(path):
+    # Readers in any thread or process run side by side but wait out a file_lock holder
+    entry = lock_registry.get(path)
+    if not fcntl or (entry and entry[3] == threading.get_ident()):
+        yield
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with builtins.open(path, 'a+') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def page_lock(comm, page_file):
+    return file_lock(os.path.join(comm, '_locks', page_file + '.lock'))
+
+def journal_lock(comm, shared=False):
+    return (shared_file_lock if shared else file_lock)(os.path.join(comm, '_versions', '_journal.lock'))
+
 def save_community_metadata(name, genre, desc, age):
     folder = f'.{name}'
     if not os.path.exists(folder):
         os.mkdir(folder)
-    meta = {'Name': name, 'Genre': genre or '', 'Description': desc or '', 'AgeRestriction': age or ''}
-    with open(os.path.join(folder, '_metadata.json'), 'w') as f:
-        json.dump(meta, f)
+    # Keep settings such as the retention policy when the details are saved again
+    meta = dict(read_metadata(folder), Name=name, Genre=genre or '', Description=desc or '', AgeRestriction=age or '')
+    atomic_write(os.path.join(folder, '_metadata.json'), json.dumps(meta))
     macro_file = os.path.join(folder, '_edit_macros.json')
     if not os.path.exists(macro_file):
-        json.dump({}, open(macro_file, 'w'))
+        atomic_write(macro_file, json.dumps({}))
     if not os.path.exists(os.path.join(folder, '_versions')):
         os.mkdir(os.path.join(folder, '_versions'))
 
+CATALOG_FILE = '.firewiki_catalog.db'
+catalog_connections = {}
+
+def catalog():
+    # One connection per thread, since sqlite3 refuses a connection made on another thread
+    key = (os.path.abspath(CATALOG_FILE), threading.get_ident())
+    db = catalog_connections.get(key)
+    if db is None:
+        db = sqlite3.connect(key[0], timeout=30, isolation_level=None)
+        db.executescript('''
+            CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER, scanned_ns INTEGER);
+            CREATE TABLE IF NOT EXISTS communities (name TEXT PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS pages (comm TEXT, name TEXT, size INTEGER, mtime REAL, ctime REAL,
+                                              versions INTEGER, last_version TEXT, PRIMARY KEY (comm, name));
+        ''')
+        catalog_connections[key] = db
+    return db
+
+def forget_catalog_connections():
+    # Pool initializer: a connection inherited over fork must never be used, so each worker opens its own
+    catalog_connections.clear()
+
+def catalog_dir_fresh(db, path):
+    # A directory scanned within a second of its mtime may have changed again inside the same tick
+    mtime_ns = os.stat(path).st_mtime_ns
+    row = db.execute('SELECT mtime_ns, scanned_ns FROM dirs WHERE path = ?', (path,)).fetchone()
+    if row and row[0] == mtime_ns and row[1] - mtime_ns > 1e9:
+        return True, mtime_ns
+    return False, mtime_ns
+
+def mark_catalog_dir(db, path, mtime_ns):
+    db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)', (path, mtime_ns, time.time_ns()))
+
+def tool_dirs():
+    # Dot-directories FireWiki keeps for itself next to the communities
+    return {os.path.abspath(d) for d in (PROFILE_DIR, RENDER_SPILL_DIR) if d}
+
+def scan_communities():
+    skip = tool_dirs()
+    with os.scandir() as entries:
+        return sorted(e.name for e in entries if e.name.startswith('.') and e.is_dir() and os.path.abspath(e.name) not in skip)
+
+@instrumented
 def load_communities():
-    return [d for d in os.listdir() if os.path.isdir(d) and d.startswith('.')]
+    if sqlite3 is None:
+        return scan_communities()
+    db = catalog()
+    fresh, mtime_ns = catalog_dir_fresh(db, '.')
+    if not fresh:
+        communities = scan_communities()
+        with db:
+            db.execute('BEGIN')
+            db.execute('DELETE FROM communities')
+            db.executemany('INSERT INTO communities VALUES (?)', [(c,) for c in communities])
+            db.execute(f'DELETE FROM pages WHERE comm NOT IN ({",".join("?" * len(communities))})', communities)
+            mark_catalog_dir(db, '.', mtime_ns)
+        return communities
+    # Filtered again, since a catalog written before a tool directory existed may still list it
+    skip = tool_dirs()
+    return [row[0] for row in db.execute('SELECT name FROM communities ORDER BY name') if os.path.abspath(row[0]) not in skip]
 
 def read_metadata(comm):
     path = os.path.join(comm, '_metadata.json')
@@ -50,194 +383,1856 @@ def load_edit_macros(comm):
     return {}
 
 def save_edit_macros(comm, data):
+    atomic_write(os.path.join(comm, '_edit_macros.json'), json.dumps(data))
+    edit_macro_cache.pop(comm, None)
+
+def cached_edit_macros(comm):
+    # Rendering consults the macros on every view of a page with @replay, so they are kept until the file changes
     path = os.path.join(comm, '_edit_macros.json')
-    with open(path, 'w') as f:
-        json.dump(data, f)
+    try:
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        stamp = None
+    cached = edit_macro_cache.get(comm)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    edit_macros = load_edit_macros(comm)
+    edit_macro_cache[comm] = (stamp, edit_macros)
+    return edit_macros
+
+def scan_pages(comm):
+    with os.scandir(comm) as entries:
+        return sorted(e.name for e in entries if e.name.endswith('.md') and not e.name.startswith('_'))
 
+def catalog_page_row(comm, page_file):
+    st = os.stat(os.path.join(comm, page_file))
+    return (comm, page_file, st.st_size, st.st_mtime, st.st_ctime)
+
+@instrumented
 def list_pages(comm):
-    return [f for f in os.listdir(comm) if f.endswith('.md') and not f.startswith('_')]
+    if sqlite3 is None:
+        return scan_pages(comm)
+    db = catalog()
+    fresh, mtime_ns = catalog_dir_fresh(db, comm)
+    if fresh:
+        return [row[0] for row in db.execute('SELECT name FROM pages WHERE comm = ? ORDER BY name', (comm,))]
 
-def render_markdown(content):
-    lines = content.split('\n')
-    rendered = []
-    in_code_block = False
-    in_list = False
-    
+    pages = scan_pages(comm)
+    known = {row[0] for row in db.execute('SELECT name FROM pages WHERE comm = ?', (comm,))}
+    current = set(pages)
+    with db:
+        db.execute('BEGIN')
+        db.executemany('DELETE FROM pages WHERE comm = ? AND name = ?', [(comm, p) for p in known - current])
+        db.executemany('INSERT INTO pages (comm, name, size, mtime, ctime) VALUES (?, ?, ?, ?, ?)',
+                       [catalog_page_row(comm, p) for p in current - known])
+        mark_catalog_dir(db, comm, mtime_ns)
+    return pages
+
+def update_catalog_pages(comm, changes):
+    if sqlite3 is None:
+        return
+    db = catalog()
+    with db:
+        db.execute('BEGIN')
+        for page_file in changes:
+            if os.path.exists(os.path.join(comm, page_file)):
+                db.execute('''INSERT INTO pages (comm, name, size, mtime, ctime) VALUES (?, ?, ?, ?, ?)
+                              ON CONFLICT (comm, name) DO UPDATE SET size = excluded.size, mtime = excluded.mtime,
+                              ctime = excluded.ctime''', catalog_page_row(comm, page_file))
+            else:
+                db.execute('DELETE FROM pages WHERE comm = ? AND name = ?', (comm, page_file))
+
+def catalog_add_versions(comm, entries):
+    if sqlite3 is None:
+        return
+    counts = {}
+    for entry in entries:
+        count, _ = counts.get(entry['page'], (0, None))
+        counts[entry['page']] = (count + 1, entry['timestamp'])
+    db = catalog()
+    with db:
+        db.execute('BEGIN')
+        db.executemany('UPDATE pages SET versions = versions + ?, last_version = ? WHERE comm = ? AND name = ?',
+                       [(count, last, comm, page_file) for page_file, (count, last) in counts.items()])
+
+def catalog_reset_versions(comm):
+    if sqlite3 is not None:
+        catalog().execute('UPDATE pages SET versions = NULL, last_version = NULL WHERE comm = ?', (comm,))
+
+MACRO_TIMEOUT = float(os.environ.get('FIREWIKI_MACRO_TIMEOUT', '2') or 2)
+MACRO_TTL = 300
+MACRO_CACHE_SIZE = 1024
+MACRO_PLUGINS = os.environ.get('FIREWIKI_MACROS', '')
+macros = {}
+macro_options = {}
+macro_cache = OrderedDict()
+
+def register_macro(name, func=None, timeout=None, ttl=None):
+    # register_macro('name', func) or @register_macro('name'). A macro gets the words after its name as
+    # arguments and may print, return text, or both; ttl=0 turns memoization off
+    def register(func):
+        macros[name] = func
+        macro_options[name] = {'timeout': MACRO_TIMEOUT if timeout is None else timeout,
+                               'ttl': MACRO_TTL if ttl is None else ttl}
+        for key in [key for key in macro_cache if key[0] == name]:
+            del macro_cache[key]
+        return func
+    return register(func) if func is not None else register
+
+register_macro('hello', lambda: print("Hello from macro!"))
+register_macro('date', lambda: datetime.now().strftime('%A %d %B %Y'), ttl=60)
+
+def load_macro_plugins(spec=MACRO_PLUGINS):
+    # FIREWIKI_MACROS lists modules or .py files that call firewiki.register_macro when imported
+    sys.modules.setdefault('firewiki', sys.modules[__name__])
+    for entry in filter(None, spec.split(os.pathsep)):
+        try:
+            if entry.endswith('.py'):
+                module_spec = importlib.util.spec_from_file_location(os.path.basename(entry)[:-3], entry)
+                module_spec.loader.exec_module(importlib.util.module_from_spec(module_spec))
+            else:
+                importlib.import_module(entry)
+        except Exception as e:
+            print(f'Could not load macro plugin {entry}: {e}', file=sys.stderr)
+
+def macro_output(func, args):
+    out = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(out):
+            result = func(*args)
+        if result is not None:
+            out.write(str(result))
+        return out.getvalue()
+    except Exception as e:
+        return f'[Macro error: {type(e).__name__}: {e}]'
+
+def macro_child(sender, func, args):
+    sender.send(macro_output(func, args))
+    sender.close()
+
+def execute_macro(func, args, timeout):
+    # A forked child captures the output, can be killed at the timeout and cannot touch this process's state.
+    # Where fork is missing the macro runs on a thread that is abandoned, not stopped, when it overruns
+    if not hasattr(os, 'fork'):
+        box = []
+        worker = threading.Thread(target=lambda: box.append(macro_output(func, args)), daemon=True)
+        worker.start()
+        worker.join(timeout)
+        return box[0] if box else None
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    child = context.Process(target=macro_child, args=(sender, func, args))
+    child.start()
+    sender.close()
+    try:
+        if receiver.poll(timeout):
+            return receiver.recv()
+        return None
+    except EOFError:
+        return '[Macro error: exited without output]'
+    finally:
+        receiver.close()
+        if child.is_alive():
+            child.kill()
+        child.join()
+
+@instrumented
+def run_macro(text, version=None):
+    # Output is memoized per (macro, arguments, page content hash) until the macro's ttl runs out
+    try:
+        words = shlex.split(text)
+    except ValueError:
+        words = text.split()
+    if not words or words[0] not in macros:
+        return None
+    name, args = words[0], words[1:]
+    options = macro_options.get(name, {'timeout': MACRO_TIMEOUT, 'ttl': MACRO_TTL})
+    key = (name, tuple(args), version)
+    cached = macro_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        macro_cache.move_to_end(key)
+        return cached[1]
+    output = execute_macro(macros[name], args, options['timeout'])
+    if output is None:
+        # Cached like any other result, so a hanging macro costs one timeout per ttl, not one per view
+        output = f'[Macro {name} timed out after {options["timeout"]:g}s]'
+    if options['ttl']:
+        macro_cache[key] = (time.monotonic() + options['ttl'], output)
+        if len(macro_cache) > MACRO_CACHE_SIZE:
+            macro_cache.popitem(last=False)
+    return output
+
+EMPHASIS = re.compile(r'\*\*?')
+WIKI_LINK = re.compile(r'\[\[([^\[\]|]+)(?:\|([^\[\]]*))?\]\]')
+RENDER_CACHE_SIZE = 256
+RENDER_SPILL_DIR = os.environ.get('FIREWIKI_RENDER_CACHE')
+render_cache = OrderedDict()
+include_cache = {}
+include_dependents = {}
+replay_cache = OrderedDict()
+edit_macro_cache = {}
+response_cache = OrderedDict()
+
+def markdown_tokens(lines, in_code_block=False):
+    # One pass over the lines; the token stream is plain tuples so it can be cached or spilled as JSON
     for line in lines:
         # Handle code blocks
         if line.strip().startswith('```'):
             in_code_block = not in_code_block
-            if in_code_block:
-                rendered.append(ansi(line, '0;37;40'))  # White on black for code blocks
-            else:
-                rendered.append(ansi(line, '0;37;40'))
-            continue
-        
-        if in_code_block:
-            rendered.append(ansi(line, '0;37;40'))
-            continue
-            
+            yield ('code', line)
+        elif in_code_block:
+            yield ('code', line)
         # Handle headers
-        if line.startswith('# '):
-            rendered.append(ansi(line[2:], '1;34'))  # Bold blue for H1
+        elif line.startswith('# '):
+            yield ('h1', line[2:])
         elif line.startswith('## '):
-            rendered.append(ansi(line[3:], '1;36'))  # Bold cyan for H2
+            yield ('h2', line[3:])
         elif line.startswith('### '):
-            rendered.append(ansi(line[4:], '1;32'))  # Bold green for H3
+            yield ('h3', line[4:])
         # Handle lists
         elif line.startswith('- ') or line.startswith('* '):
-            if not in_list:
-                in_list = True
-            bullet = '• ' if line.startswith('- ') else '◦ '
-            rendered.append(ansi(bullet + line[2:], '0;33'))  # Yellow for list items
+            yield ('bullet', ('• ' if line[0] == '-' else '◦ ') + line[2:])
         elif line.startswith('> '):
-            rendered.append(ansi(line, '0;35'))  # Magenta for blockquotes
+            yield ('quote', line)
         # Handle inline code
         elif '`' in line:
-            parts = line.split('`')
-            for i, part in enumerate(parts):
-                if i % 2 == 1:  # Odd parts are inside backticks
-                    rendered_part = ansi(part, '0;37;40')  # White on black for inline code
-                else:
-                    # Handle bold and italic in text
-                    part = part.replace('**', '\033[1m').replace('*', '\033[3m') + '\033[0m'
-                    rendered_part = part
-                if i > 0:
-                    rendered[-1] += rendered_part
-                else:
-                    rendered.append(rendered_part)
+            yield ('inline', line.split('`'))
         # Handle macros and special tags
         elif line.startswith('@macro '):
-            macro_name = line[7:].strip()
-            rendered.append(ansi(f'[Macro: {macro_name}]', '1;35'))
-            if macro_name in macros:
-                macros[macro_name]()
+            yield ('macro', line[7:].strip())
         elif line.startswith('@replay '):
-            rendered.append(ansi(f'[Edit Macro: {line[8:]}]', '1;36'))
+            yield ('replay', line[8:])
+        elif line.startswith('@include '):
+            yield ('include', line[9:].strip())
         elif line.startswith('#tag '):
-            rendered.append(ansi(f'[Tag: {line[5:]}]', '1;33'))
+            yield ('tag', line[5:])
         # Handle horizontal rules
         elif line.strip() in ('---', '***', '___'):
-            rendered.append(ansi('─' * 40, '0;36'))  # Cyan horizontal rule
-        # Handle regular text with formatting
+            yield ('hr', '')
         else:
-            if line.strip() == '' and in_list:
-                in_list = False
-            # Handle bold and italic text
-            formatted_line = line.replace('**', '\033[1m').replace('*', '\033[3m') + '\033[0m'
-            rendered.append(formatted_line)
-    
-    return '\n'.join(rendered)
+            yield ('text', line)
+
+def emphasis(text):
+    # Wiki links show their label underlined, then bold and italic text
+    text = WIKI_LINK.sub(lambda m: f'\033[4;34m{m.group(2) or m.group(1)}\033[24;39m', text)
+    return EMPHASIS.sub(lambda m: '\033[1m' if len(m.group()) == 2 else '\033[3m', text) + '\033[0m'
+
+def linked(text, code):
+    # Wiki links inside a coloured line: the underlined label, then back to the line's colour
+    return ansi(WIKI_LINK.sub(lambda m: f'\033[4;34m{m.group(2) or m.group(1)}\033[0;{code}m', text), code)
+
+def render_token(token, version=None):
+    kind, value = token
+    if kind == 'code':
+        return ansi(value, '0;37;40')  # White on black for code blocks
+    if kind == 'h1':
+        return linked(value, '1;34')  # Bold blue for H1
+    if kind == 'h2':
+        return linked(value, '1;36')  # Bold cyan for H2
+    if kind == 'h3':
+        return linked(value, '1;32')  # Bold green for H3
+    if kind == 'bullet':
+        return linked(value, '0;33')  # Yellow for list items
+    if kind == 'quote':
+        return linked(value, '0;35')  # Magenta for blockquotes
+    if kind == 'inline':
+        # Odd parts are inside backticks
+        return ''.join(ansi(part, '0;37;40') if i % 2 else emphasis(part) for i, part in enumerate(value))
+    if kind == 'macro':
+        output = run_macro(value, version)
+        label = ansi(f'[Macro: {value}]', '1;35')
+        return label + '\n' + output.rstrip('\n') if output else label
+    if kind == 'replay':
+        return ansi(f'[Edit Macro: {value}]', '1;36')
+    if kind == 'include':
+        # Only seen where includes are not expanded, such as the streaming viewer
+        return ansi(f'[Include: {value}]', '1;36')
+    if kind == 'notice':
+        return ansi(value, '1;31')
+    if kind == 'tag':
+        return ansi(f'[Tag: {value}]', '1;33')
+    if kind == 'hr':
+        return ansi('─' * 40, '0;36')  # Cyan horizontal rule
+    return emphasis(value)
+
+def render_tokens(tokens, version=None):
+    return '\n'.join(render_token(token, version) for token in tokens)
+
+@instrumented
+def render_markdown(content):
+    return render_tokens(markdown_tokens(content.split('\n')), content_digest(content))
+
+def spill_render_tokens(digest, tokens):
+    if not RENDER_SPILL_DIR:
+        return
+    os.makedirs(RENDER_SPILL_DIR, exist_ok=True)
+    atomic_write(os.path.join(RENDER_SPILL_DIR, digest + '.json'), json.dumps(tokens), durable=False)
+
+def load_spilled_tokens(digest):
+    if not RENDER_SPILL_DIR:
+        return None
+    path = os.path.join(RENDER_SPILL_DIR, digest + '.json')
+    if not os.path.exists(path):
+        return None
+    return [tuple(token) for token in json.load(open(path))]
+
+@instrumented
+def page_tokens(path, with_digest=False):
+    # Cache key is (path, mtime, size) -> (content hash, tokens); an unchanged page is neither read nor parsed
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    cached = render_cache.get(key)
+    if cached:
+        render_cache.move_to_end(key)
+        return cached if with_digest else cached[1]
+
+    with open(path) as f:
+        content = f.read()
+    digest = content_digest(content)
+    tokens = load_spilled_tokens(digest)
+    if tokens is None:
+        tokens = list(markdown_tokens(content.split('\n')))
+    render_cache[key] = (digest, tokens)
+    if len(render_cache) > RENDER_CACHE_SIZE:
+        _, (old_digest, old_tokens) = render_cache.popitem(last=False)
+        spill_render_tokens(old_digest, old_tokens)
+    return (digest, tokens) if with_digest else tokens
+
+def invalidate_render_cache(path):
+    for key in [key for key in render_cache if key[0] == path]:
+        del render_cache[key]
+    response_cache.pop(path, None)
+    # Expansions of every page that includes this one, directly or not, are stale too
+    for dependent in include_dependents.pop(path, set()) | {path}:
+        include_cache.pop(dependent, None)
+
+def replayed_tokens(path):
+    # (hash, tokens) of the page as shown: every @replay macro applied, in order, to the content in memory.
+    # The file is never touched; results are memoized by (page hash, hash of the macro definitions used)
+    digest, tokens = page_tokens(path, with_digest=True)
+    replays = [value.strip() for kind, value in tokens if kind == 'replay']
+    if not replays:
+        return digest, tokens
+    edit_macros = cached_edit_macros(os.path.dirname(path))
+    definitions = content_digest(json.dumps([[name, edit_macros.get(name)] for name in replays]))
+    key = (digest, definitions)
+    cached = replay_cache.get(key)
+    if cached:
+        replay_cache.move_to_end(key)
+        return cached
+    with open(path) as f:
+        lines = f.read().split('\n')
+    for name in replays:
+        if name in edit_macros:
+            lines = apply_edit_macro(lines, edit_macros[name])
+    content = '\n'.join(lines)
+    replay_cache[key] = (content_digest(content), list(markdown_tokens(lines)))
+    if len(replay_cache) > RENDER_CACHE_SIZE:
+        replay_cache.popitem(last=False)
+    return replay_cache[key]
+
+def expand_includes(comm, tokens, stack, deps):
+    out = []
+    for kind, value in tokens:
+        if kind != 'include':
+            out.append((kind, value))
+            continue
+        comm_name, target = link_target(value)
+        target_comm = community_path(comm_name) if comm_name else comm
+        path = os.path.join(target_comm, target)
+        # Only real communities and plain page names, so an include can never reach outside the wiki
+        if comm_name and ('/' in comm_name or target_comm not in load_communities()):
+            out.append(('notice', f'[Included page not found: {value}]'))
+        elif path in stack:
+            out.append(('notice', f'[Include cycle: {" -> ".join(stack[stack.index(path):] + [path])}]'))
+        elif '/' in target or target.startswith(('.', '_')) or not os.path.isfile(path):
+            deps.append((path, None))
+            out.append(('notice', f'[Included page not found: {value}]'))
+        else:
+            digest, included = replayed_tokens(path)
+            deps.append((path, digest))
+            out.extend(expand_includes(target_comm, included, stack + [path], deps))
+    return out
+
+def expanded_tokens(comm, page_file):
+    # (version, tokens, deps) with every @include replaced by the included page's tokens. deps lists
+    # (path, content hash) for the page and everything it pulled in; version hashes them all, so macro
+    # results and ETags change when any fragment does
+    path = os.path.join(comm, page_file)
+    digest, tokens = replayed_tokens(path)
+    if not any(kind == 'include' for kind, _ in tokens):
+        return digest, tokens, [(path, digest)]
+    cached = include_cache.get(path)
+    if cached and all((replayed_tokens(dep)[0] if os.path.isfile(dep) else None) == dep_digest
+                      for dep, dep_digest in cached[2]):
+        return cached
+    deps = [(path, digest)]
+    expanded = expand_includes(comm, tokens, [path], deps)
+    version = content_digest(''.join(f'{dep}\0{dep_digest}\n' for dep, dep_digest in deps))
+    include_cache[path] = (version, expanded, deps)
+    for dep, _ in deps[1:]:
+        include_dependents.setdefault(dep, set()).add(path)
+    return include_cache[path]
+
+VERSION_SNAPSHOT_INTERVAL = 16
+
+def content_digest(content):
+    return hashlib.sha256(content.encode()).hexdigest()
+
+def blob_path(comm, digest):
+    return os.path.join(comm, '_versions', '_objects', digest[:2], digest[2:])
+
+def load_blob_record(comm, digest):
+    with open(blob_path(comm, digest), 'rb') as f:
+        return json.loads(zlib.decompress(f.read()))
+
+def compute_delta(base_lines, lines):
+    ops = []
+    matcher = difflib.SequenceMatcher(None, base_lines, lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append(['=', i1, i2])
+        elif j2 > j1:
+            ops.append(['+', lines[j1:j2]])
+    return ops
+
+def apply_delta(base_lines, ops):
+    lines = []
+    for op in ops:
+        if op[0] == '=':
+            lines.extend(base_lines[op[1]:op[2]])
+        else:
+            lines.extend(op[1])
+    return lines
+
+@instrumented
+def store_blob(comm, content, base_digest=None):
+    digest = content_digest(content)
+    path = blob_path(comm, digest)
+    if os.path.exists(path):
+        # A fresh mtime keeps the blob out of a concurrent garbage collection's sweep
+        os.utime(path)
+        return digest
+
+    record = {'type': 'full', 'content': content}
+    if base_digest and base_digest != digest and os.path.exists(blob_path(comm, base_digest)):
+        base_record = load_blob_record(comm, base_digest)
+        depth = base_record.get('depth', 0) + 1
+        # Every VERSION_SNAPSHOT_INTERVAL revisions a full snapshot bounds the delta chain
+        if depth < VERSION_SNAPSHOT_INTERVAL:
+            ops = compute_delta(read_blob(comm, base_digest).split('\n'), content.split('\n'))
+            delta = {'type': 'delta', 'base': base_digest, 'depth': depth, 'ops': ops}
+            if len(json.dumps(ops)) < len(content):
+                record = delta
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Concurrent writers may store the same blob; readers only ever see a complete file
+    atomic_write(path, zlib.compress(json.dumps(record).encode()))
+    return digest
+
+@instrumented
+def read_blob(comm, digest):
+    return resolve_blob(lambda digest: load_blob_record(comm, digest), digest)
+
+def resolve_blob(load_record, digest):
+    # Shared by the loose object store and pack files, which only differ in where records come from
+    chain = []
+    record = load_record(digest)
+    while record['type'] == 'delta':
+        chain.append(record['ops'])
+        record = load_record(record['base'])
+    lines = record['content'].split('\n')
+    for ops in reversed(chain):
+        lines = apply_delta(lines, ops)
+    return '\n'.join(lines)
+
+VERSION_RECORD = struct.Struct('<QQ')
+
+def version_journal_path(comm):
+    return os.path.join(comm, '_versions', '_journal.jsonl')
+
+def version_index_path(comm, page_file):
+    return os.path.join(comm, '_versions', '_index', page_file + '.idx')
+
+def write_version_journal(comm, entries):
+    # Full rewrite, only for migrations and compaction; saves go through append_version_entries
+    journal = version_journal_path(comm)
+    index_dir = os.path.join(comm, '_versions', '_index')
+    records = {}
+    offset = 0
+    with journal_lock(comm), durability_batch():
+        with atomic_open(journal, 'wb') as f:
+            for entry in entries:
+                line = (json.dumps(entry) + '\n').encode()
+                records.setdefault(entry['page'], bytearray()).extend(VERSION_RECORD.pack(offset, len(line)))
+                f.write(line)
+                offset += len(line)
+        if os.path.exists(index_dir):
+            shutil.rmtree(index_dir)
+        os.makedirs(index_dir)
+        for page_file, packed in records.items():
+            atomic_write(version_index_path(comm, page_file), packed)
+    catalog_reset_versions(comm)
+
+def migrate_version_log(comm):
+    version_log = os.path.join(comm, '_versions', '_version_log.json')
+    if not os.path.exists(version_log):
+        return
+    with journal_lock(comm):
+        if not os.path.exists(version_log):
+            return
+        log_data = json.load(open(version_log))
+        entries = []
+        for page_file, versions in log_data.items():
+            for version in versions:
+                entries.append(dict(version, page=page_file))
+        entries.sort(key=lambda entry: entry['timestamp'])
+        write_version_journal(comm, load_version_journal(comm) + entries)
+        os.remove(version_log)
 
+def load_version_journal(comm):
+    journal = version_journal_path(comm)
+    entries = []
+    if os.path.exists(journal):
+        with open(journal, 'rb') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # A torn trailing record from an interrupted append
+                    continue
+    return entries
+
+def compact_version_journal(comm):
+    migrate_version_log(comm)
+    with journal_lock(comm):
+        write_version_journal(comm, load_version_journal(comm))
+
+def truncate_torn_tail(path, record_size=None):
+    # Cuts a partial record left by an interrupted append; fixed-size records or newline-terminated lines
+    if not os.path.exists(path):
+        return False
+    with open(path, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        if record_size:
+            end = size - size % record_size
+        else:
+            end = size
+            while end:
+                start = max(0, end - 65536)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b'\n')
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+        if end == size:
+            return False
+        f.truncate(end)
+    return True
+
+@instrumented
+def append_version_entries(comm, entries):
+    migrate_version_log(comm)
+    os.makedirs(os.path.join(comm, '_versions', '_index'), exist_ok=True)
+    lines = [(json.dumps(entry) + '\n').encode() for entry in entries]
+    # Offsets into the journal are only valid if no other writer appends in between
+    with journal_lock(comm), durability_batch():
+        torn = truncate_torn_tail(version_journal_path(comm))
+        for page_file in {entry['page'] for entry in entries}:
+            torn = truncate_torn_tail(version_index_path(comm, page_file), VERSION_RECORD.size) or torn
+        if torn:
+            # An append was cut short somewhere, so indexes may be missing records the journal has
+            compact_version_journal(comm)
+        offset = append_durable(version_journal_path(comm), b''.join(lines))
+        records = {}
+        for entry, line in zip(entries, lines):
+            records.setdefault(entry['page'], bytearray()).extend(VERSION_RECORD.pack(offset, len(line)))
+            offset += len(line)
+        for page_file, packed in records.items():
+            append_durable(version_index_path(comm, page_file), packed)
+    catalog_add_versions(comm, entries)
+
+def count_page_versions(comm, page_file):
+    migrate_version_log(comm)
+    path = version_index_path(comm, page_file)
+    if not os.path.exists(path):
+        return 0
+    return os.path.getsize(path) // VERSION_RECORD.size
+
+def read_version_records(comm, page_file, start, stop):
+    with open(version_index_path(comm, page_file), 'rb') as f:
+        f.seek(start * VERSION_RECORD.size)
+        raw = f.read((stop - start) * VERSION_RECORD.size)
+    entries = []
+    with open(version_journal_path(comm), 'rb') as f:
+        for offset, length in VERSION_RECORD.iter_unpack(raw):
+            f.seek(offset)
+            entries.append(json.loads(f.read(length)))
+    return entries
+
+@instrumented
+def load_page_versions(comm, page_file):
+    migrate_version_log(comm)
+    # Shared with other readers; a journal rewrite swaps the journal and every index under the exclusive lock
+    with journal_lock(comm, shared=True):
+        count = count_page_versions(comm, page_file)
+        return read_version_records(comm, page_file, 0, count) if count else []
+
+def last_page_version(comm, page_file):
+    migrate_version_log(comm)
+    with journal_lock(comm, shared=True):
+        count = count_page_versions(comm, page_file)
+        return read_version_records(comm, page_file, count - 1, count)[0] if count else None
+
+def version_entry(page_file, digest, operation):
+    return {
+        'page': page_file,
+        'timestamp': datetime.now().strftime("%Y%m%d_%H%M%S"),
+        'hash': digest[:8],
+        'operation': operation,
+        'blob': digest
+    }
+
+@instrumented
 def create_version(comm, page_file, content, operation):
-    version_dir = os.path.join(comm, '_versions', page_file)
-    if not os.path.exists(version_dir):
-        os.makedirs(version_dir)
+    last = last_page_version(comm, page_file)
+    # A snapshot of exactly the newest version (edit_pre after edit_post, say) adds nothing to the history
+    if last and last.get('blob') == content_digest(content):
+        return last['blob']
+    digest = store_blob(comm, content, last.get('blob') if last else None)
+    append_version_entries(comm, [version_entry(page_file, digest, operation)])
+    return digest
+
+def read_version(comm, page_file, version):
+    if 'blob' in version:
+        return read_blob(comm, version['blob'])
+    version_path = os.path.join(comm, '_versions', page_file, version['version_file'])
+    if os.path.exists(version_path):
+        with open(version_path, 'r') as f:
+            return f.read()
+    return None
+
+@instrumented
+def pack_versions(comm):
+    migrate_version_log(comm)
+    with journal_lock(comm):
+        pack_journal_versions(comm)
+
+def pack_journal_versions(comm):
+    entries = load_version_journal(comm)
+    if not entries:
+        print("No version history available.")
+        return
+
+    base_digests = {}
+    packed = []
+    reclaimed = 0
+    with durability_batch():
+        for entry in entries:
+            page_file = entry['page']
+            if 'blob' in entry:
+                base_digests[page_file] = entry['blob']
+                continue
+            version_path = os.path.join(comm, '_versions', page_file, entry['version_file'])
+            if not os.path.exists(version_path):
+                continue
+            with open(version_path, 'r') as f:
+                content = f.read()
+            digest = store_blob(comm, content, base_digests.get(page_file))
+            base_digests[page_file] = digest
+            entry['blob'] = digest
+            entry['hash'] = digest[:8]
+            del entry['version_file']
+            reclaimed += os.path.getsize(version_path)
+            packed.append(version_path)
+
+        # The journal must point at the blobs before the loose copies go away
+        write_version_journal(comm, entries)
+    for version_path in packed:
+        os.remove(version_path)
+        version_dir = os.path.dirname(version_path)
+        if not os.listdir(version_dir):
+            os.rmdir(version_dir)
+    print(f'Packed {len(packed)} versions, {reclaimed} bytes of loose copies removed.')
+
+RETENTION_KEYS = ('keep_all_days', 'daily_days', 'weekly_days', 'max_versions')
+GC_GRACE_SECONDS = 3600
+GC_SHARDS = 256
 
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    content_hash = hashlib.md5(content.encode()).hexdigest()[:8]
-    version_file = os.path.join(version_dir, f"{timestamp}_{content_hash}_{operation}.md")
+def retention_policy(comm):
+    return read_metadata(comm).get('Retention', {})
 
-    with open(version_file, 'w') as f:
-        f.write(content)
+def save_retention_policy(comm, policy):
+    meta = read_metadata(comm)
+    meta['Retention'] = {key: policy[key] for key in RETENTION_KEYS if policy.get(key) is not None}
+    atomic_write(os.path.join(comm, '_metadata.json'), json.dumps(meta))
+
+def retained_versions(versions, policy, now):
+    # versions are oldest first; returns the positions to keep. Without keep_all_days nothing expires,
+    # a missing daily_days or weekly_days makes that tier unbounded, and the newest version always stays
+    keep = {len(versions) - 1}
+    keep_all = policy.get('keep_all_days')
+    daily = policy.get('daily_days')
+    weekly = policy.get('weekly_days')
+    buckets = set()
+    for i in reversed(range(len(versions))):
+        try:
+            when = datetime.strptime(versions[i]['timestamp'], "%Y%m%d_%H%M%S")
+        except ValueError:
+            keep.add(i)
+            continue
+        age = (now - when).total_seconds() / 86400
+        if keep_all is None or age < keep_all:
+            keep.add(i)
+            continue
+        if daily is None or age < daily:
+            bucket = ('day', when.date())
+        elif weekly is None or age < weekly:
+            bucket = ('week',) + tuple(when.isocalendar()[:2])
+        else:
+            continue
+        # Newest first, so each day or week keeps its last version
+        if bucket not in buckets:
+            buckets.add(bucket)
+            keep.add(i)
+    if policy.get('max_versions'):
+        keep = set(sorted(keep)[-policy['max_versions']:])
+    return keep
+
+def reachable_blobs(comm, entries):
+    reachable = set()
+    for entry in entries:
+        digest = entry.get('blob')
+        # Delta bases stay alive as long as anything built on them does
+        while digest and digest not in reachable:
+            reachable.add(digest)
+            if not os.path.exists(blob_path(comm, digest)):
+                break
+            record = load_blob_record(comm, digest)
+            digest = record.get('base') if record['type'] == 'delta' else None
+    return reachable
+
+@instrumented
+def collect_versions(comm, steps=None, dry_run=False):
+    # Applies the retention policy, drops the history of pages that no longer exist, compacts the journal
+    # and sweeps unreferenced blobs. With steps only that many of the 256 object directories are swept per
+    # run, resuming where the previous run stopped
+    migrate_version_log(comm)
+    policy = retention_policy(comm)
+    pages = set(list_pages(comm))
+    now = datetime.now()
+    state_path = os.path.join(comm, '_versions', '_gc.json')
+    state = json.load(open(state_path)) if os.path.exists(state_path) else {'cursor': 0}
+    journal = version_journal_path(comm)
+    reclaimed = {'journal': 0, 'blobs': 0, 'legacy': 0}
+    swept = removed_blobs = 0
+
+    with journal_lock(comm):
+        entries = load_version_journal(comm)
+        by_page = {}
+        for i, entry in enumerate(entries):
+            by_page.setdefault(entry['page'], []).append(i)
+        keep = set()
+        for page_file, positions in by_page.items():
+            if page_file in pages:
+                keep.update(positions[k] for k in retained_versions([entries[i] for i in positions], policy, now))
+        kept = [entry for i, entry in enumerate(entries) if i in keep]
+        dropped = [entry for i, entry in enumerate(entries) if i not in keep]
+
+        if dropped:
+            before = os.path.getsize(journal) if os.path.exists(journal) else 0
+            if not dry_run:
+                write_version_journal(comm, kept)
+            after = os.path.getsize(journal) if not dry_run else sum(len(json.dumps(e)) + 1 for e in kept)
+            reclaimed['journal'] = before - after
+        for entry in dropped:
+            if 'version_file' in entry:
+                version_path = os.path.join(comm, '_versions', entry['page'], entry['version_file'])
+                if os.path.exists(version_path):
+                    reclaimed['legacy'] += os.path.getsize(version_path)
+                    if not dry_run:
+                        os.remove(version_path)
+                        if not os.listdir(os.path.dirname(version_path)):
+                            os.rmdir(os.path.dirname(version_path))
+
+        reachable = reachable_blobs(comm, kept)
+        cutoff = time.time() - GC_GRACE_SECONDS
+        start = state['cursor']
+        count = GC_SHARDS if steps is None else min(steps, GC_SHARDS)
+        for shard in range(start, start + count):
+            prefix = f'{shard % GC_SHARDS:02x}'
+            shard_dir = os.path.join(comm, '_versions', '_objects', prefix)
+            swept += 1
+            if not os.path.isdir(shard_dir):
+                continue
+            for name in os.listdir(shard_dir):
+                path = os.path.join(shard_dir, name)
+                if prefix + name in reachable or name.endswith('.tmp'):
+                    continue
+                st = os.stat(path)
+                # Blobs written moments ago may belong to a save that has not reached the journal yet
+                if st.st_mtime > cutoff:
+                    continue
+                reclaimed['blobs'] += st.st_size
+                removed_blobs += 1
+                if not dry_run:
+                    os.remove(path)
+            if not dry_run and not os.listdir(shard_dir):
+                os.rmdir(shard_dir)
+        if not dry_run:
+            atomic_write(state_path, json.dumps({'cursor': (start + count) % GC_SHARDS, 'last_run': now.strftime("%Y%m%d_%H%M%S")}),
+                         durable=False)
+
+    total = sum(reclaimed.values())
+    verb = 'Would reclaim' if dry_run else 'Reclaimed'
+    print(f"{verb} {total} bytes: {len(dropped)} versions expired, {removed_blobs} blobs ({reclaimed['blobs']} bytes), "
+          f"journal {reclaimed['journal']} bytes, loose copies {reclaimed['legacy']} bytes; swept {swept}/{GC_SHARDS} object directories.")
+    return {'versions': len(dropped), 'blobs': removed_blobs, 'bytes': total, **reclaimed}
+
+def collect_versions_background(comm, steps=None):
+    # A detached, low-priority copy of ourselves, so the menu or a cron job returns immediately
+    command = [sys.executable, os.path.abspath(__file__), 'community', 'gc', comm[1:]]
+    if steps:
+        command += ['--steps', str(steps)]
+    log = open(os.path.join(comm, '_versions', '_gc.log'), 'a')
+    subprocess.Popen(command, stdout=log, stderr=log, stdin=subprocess.DEVNULL, start_new_session=True,
+                     preexec_fn=(lambda: os.nice(10)) if hasattr(os, 'nice') else None)
+    print(f"Garbage collection started in the background; output goes to {log.name}.")
+
+def collect_versions_prompt(comm):
+    policy = retention_policy(comm)
+    print("Retention policy: " + (', '.join(f'{key}={value}' for key, value in policy.items()) or 'keep everything'))
+    if input("Change it? (y/n): ").lower() == 'y':
+        updated = {}
+        for key in RETENTION_KEYS:
+            value = input_optional(f'{key} (current: {policy.get(key, "unset")})')
+            if value is not None and not value.isdigit():
+                print("Invalid input.")
+                return
+            updated[key] = int(value) if value else None
+        save_retention_policy(comm, updated)
+    if input("Run in the background? (y/n): ").lower() == 'y':
+        collect_versions_background(comm)
+    else:
+        collect_versions(comm)
+
+@instrumented
+def get_page_info(comm, page_file):
+    st = os.stat(os.path.join(comm, page_file))
+    info = {
+        'name': page_file,
+        'size': st.st_size,
+        'created': datetime.fromtimestamp(st.st_ctime).strftime("%Y-%m-%d %H:%M:%S"),
+        'modified': datetime.fromtimestamp(st.st_mtime).strftime("%Y-%m-%d %H:%M:%S"),
+        'versions': 0
+    }
+    row = None
+    if sqlite3 is not None:
+        row = catalog().execute('SELECT versions, last_version FROM pages WHERE comm = ? AND name = ?',
+                                (comm, page_file)).fetchone()
+    if row and row[0] is not None:
+        info['versions'] = row[0]
+        info['last_version'] = row[1]
+    else:
+        migrate_version_log(comm)
+        with journal_lock(comm, shared=True):
+            info['versions'] = count_page_versions(comm, page_file)
+            info['last_version'] = last_page_version(comm, page_file)['timestamp'] if info['versions'] else None
+        if row:
+            catalog().execute('UPDATE pages SET versions = ?, last_version = ? WHERE comm = ? AND name = ?',
+                              (info['versions'], info['last_version'], comm, page_file))
+
+    return info
+
+def show_page_info(comm, page_file):
+    info = get_page_info(comm, page_file)
+    print(f"\nPage Information: {info['name']}")
+    print(f"Size: {info['size']} bytes")
+    print(f"Created: {info['created']}")
+    print(f"Last Modified: {info['modified']}")
+    print(f"Version History: {info['versions']} saved versions")
+    if info['versions'] > 0:
+        print(f"Last Version: {info['last_version']}")
+
+DIFF_CONTEXT = 3
+DIFF_CACHE_SIZE = 64
+DIFF_FALLBACK_CELLS = 4_000_000
+diff_cache = OrderedDict()
+
+def unique_lines(lines, lo, hi):
+    # line -> its index if it occurs once in lines[lo:hi], -1 otherwise
+    seen = {}
+    for i in range(lo, hi):
+        seen[lines[i]] = i if lines[i] not in seen else -1
+    return seen
+
+def patience_anchors(a, alo, ahi, b, blo, bhi):
+    in_b = unique_lines(b, blo, bhi)
+    pairs = sorted((i, in_b[line]) for line, i in unique_lines(a, alo, ahi).items() if i >= 0 and in_b.get(line, -1) >= 0)
+    # Longest increasing run of b positions, by patience sorting
+    tails, tail_pairs, previous = [], [], [None] * len(pairs)
+    for k, (i, j) in enumerate(pairs):
+        pos = bisect.bisect_left(tails, j)
+        if pos:
+            previous[k] = tail_pairs[pos - 1]
+        if pos == len(tails):
+            tails.append(j)
+            tail_pairs.append(k)
+        else:
+            tails[pos] = j
+            tail_pairs[pos] = k
+    anchors = []
+    k = tail_pairs[-1] if tail_pairs else None
+    while k is not None:
+        anchors.append(pairs[k])
+        k = previous[k]
+    return anchors[::-1]
+
+def diff_matches(a, b):
+    # Patience diff: match lines unique to both sides and recurse between them. Regions without such anchors
+    # fall back to difflib, windowed once they are large, so multi-MB pages stay close to linear
+    matches = []
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matches.append((alo, blo))
+            alo, blo = alo + 1, blo + 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi, bhi = ahi - 1, bhi - 1
+            matches.append((ahi, bhi))
+        if alo == ahi or blo == bhi:
+            continue
+        anchors = patience_anchors(a, alo, ahi, b, blo, bhi)
+        if anchors:
+            for i, j in anchors:
+                stack.append((alo, i, blo, j))
+                matches.append((i, j))
+                alo, blo = i + 1, j + 1
+            stack.append((alo, ahi, blo, bhi))
+        elif (ahi - alo) * (bhi - blo) <= DIFF_FALLBACK_CELLS:
+            blocks = difflib.SequenceMatcher(None, a[alo:ahi], b[blo:bhi], autojunk=False).get_matching_blocks()
+            matches.extend((alo + i + k, blo + j + k) for i, j, n in blocks for k in range(n))
+        else:
+            matches.extend(window_matches(a, alo, ahi, b, blo, bhi))
+    matches.sort()
+    return matches
+
+def window_matches(a, alo, ahi, b, blo, bhi):
+    # A region without unique lines too big for one difflib call: difflib on small windows along the diagonal,
+    # keeping only the matches in the first half of each, so the next window starts from a settled point
+    window = max(2, math.isqrt(DIFF_FALLBACK_CELLS) // 4)
+    matches = []
+    while alo < ahi and blo < bhi:
+        wa, wb = min(ahi, alo + window), min(bhi, blo + window)
+        blocks = difflib.SequenceMatcher(None, a[alo:wa], b[blo:wb], autojunk=False).get_matching_blocks()
+        found = [(alo + i + k, blo + j + k) for i, j, n in blocks for k in range(n)]
+        if wa == ahi and wb == bhi:
+            return matches + found
+        kept = [(i, j) for i, j in found if i < alo + window // 2 and j < blo + window // 2] or found[:1]
+        matches.extend(kept)
+        alo, blo = (kept[-1][0] + 1, kept[-1][1] + 1) if kept else (wa, wb)
+    return matches
+
+def diff_opcodes(a, b):
+    opcodes = []
+    i = j = 0
+    for mi, mj in diff_matches(a, b) + [(len(a), len(b))]:
+        if i < mi or j < mj:
+            opcodes.append(('change', i, mi, j, mj))
+        if mi < len(a):
+            if opcodes and opcodes[-1][0] == 'equal' and opcodes[-1][2] == mi and opcodes[-1][4] == mj:
+                opcodes[-1] = ('equal', opcodes[-1][1], mi + 1, opcodes[-1][3], mj + 1)
+            else:
+                opcodes.append(('equal', mi, mi + 1, mj, mj + 1))
+        i, j = mi + 1, mj + 1
+    return opcodes
+
+def hunk_range(start, stop):
+    length = stop - start
+    if length == 1:
+        return f'{start + 1}'
+    return f'{start + 1 if length else start},{length}'
+
+def diff_hunk_lines(a, b, context=DIFF_CONTEXT):
+    # Unified diff hunks without the ---/+++ header, grouped the way difflib.unified_diff does
+    codes = diff_opcodes(a, b)
+    if all(code[0] == 'equal' for code in codes):
+        return
+    tag, i1, i2, j1, j2 = codes[0]
+    if tag == 'equal':
+        codes[0] = (tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2)
+    tag, i1, i2, j1, j2 = codes[-1]
+    if tag == 'equal':
+        codes[-1] = (tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context))
+    groups, group = [], []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > 2 * context and group:
+            group.append((tag, i1, i1 + context, j1, j1 + context))
+            groups.append(group)
+            group = []
+            i1, j1 = i2 - context, j2 - context
+        group.append((tag, i1, i2, j1, j2))
+    groups.append(group)
+    for group in groups:
+        yield f'@@ -{hunk_range(group[0][1], group[-1][2])} +{hunk_range(group[0][3], group[-1][4])} @@'
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                yield from (' ' + line for line in a[i1:i2])
+            else:
+                yield from ('-' + line for line in a[i1:i2])
+                yield from ('+' + line for line in b[j1:j2])
+
+def diff_contents(old, new, from_label, to_label, context=DIFF_CONTEXT):
+    # Hunks are cached by the two content hashes, so revisit pairs while browsing history are free
+    key = (content_digest(old), content_digest(new), context)
+    hunks = diff_cache.get(key)
+    if hunks is not None:
+        diff_cache.move_to_end(key)
+    elif key[0] != key[1]:
+        hunks = []
+        for line in diff_hunk_lines(old.split('\n'), new.split('\n'), context):
+            if not hunks:
+                yield f'--- {from_label}'
+                yield f'+++ {to_label}'
+            hunks.append(line)
+            yield line
+        diff_cache[key] = hunks
+        if len(diff_cache) > DIFF_CACHE_SIZE:
+            diff_cache.popitem(last=False)
+        return
+    if hunks:
+        yield f'--- {from_label}'
+        yield f'+++ {to_label}'
+        yield from hunks
+
+def version_label(page_file, version):
+    if version is None:
+        return f'{page_file} (current)'
+    return f"{page_file} @ {version['timestamp']} ({version['operation']})"
+
+def diff_versions(comm, page_file, old_version, new_version=None, context=DIFF_CONTEXT):
+    # Either side may be None for the working page; returns None when a revision cannot be read
+    contents = []
+    for version in (old_version, new_version):
+        content = get_page(comm, page_file) if version is None else read_version(comm, page_file, version)
+        if content is None:
+            return None
+        contents.append(content)
+    return diff_contents(contents[0], contents[1], version_label(page_file, old_version),
+                         version_label(page_file, new_version), context)
+
+def diff_versions_text(comm, page_file, old_version, new_version=None):
+    # The whole diff as one string, which unlike the line generator can come back from a worker process
+    lines = diff_versions(comm, page_file, old_version, new_version)
+    return None if lines is None else ''.join(line + '\n' for line in lines)
+
+def print_diff(lines):
+    shown = False
+    for line in lines:
+        shown = True
+        if line.startswith(('---', '+++')):
+            print(ansi(line, '1'))
+        elif line.startswith('@@'):
+            print(ansi(line, '0;36'))
+        elif line.startswith('+'):
+            print(ansi(line, '0;32'))
+        elif line.startswith('-'):
+            print(ansi(line, '0;31'))
+        else:
+            print(line)
+    if not shown:
+        print("No differences.")
+
+@instrumented
+def view_version_history(comm, page_file):
+    versions = load_page_versions(comm, page_file)
+    if not versions:
+        print("No version history for this page.")
+        return
+
+    print(f"\nVersion History for {page_file}:")
+    for i, version in enumerate(reversed(versions)):
+        print(f"{i+1}. {version['timestamp']} - {version['operation']} - Hash: {version['hash']}")
+
+def compare_versions(comm, page_file):
+    versions = load_page_versions(comm, page_file)
+    if not versions:
+        return
+    choice = input("\nCompare versions (e.g. '3 1', one number compares with the current page, Enter to skip): ").split()
+    if not choice:
+        return
+    try:
+        numbers = [int(c) for c in choice[:2]]
+    except ValueError:
+        print("Invalid input.")
+        return
+    if not all(1 <= n <= len(versions) for n in numbers):
+        print("Invalid selection.")
+        return
+    lines = diff_versions(comm, page_file, versions[-numbers[0]], versions[-numbers[1]] if len(numbers) > 1 else None)
+    if lines is None:
+        print("Version file not found.")
+        return
+    print_diff(lines)
+
+@instrumented
+def restore_version(comm, page_file):
+    versions = load_page_versions(comm, page_file)
+    if not versions:
+        print("No version history for this page.")
+        return
+
+    view_version_history(comm, page_file)
+    try:
+        choice = int(input("\nSelect version to restore (number): "))
+        if choice < 1 or choice > len(versions):
+            print("Invalid selection.")
+            return
+
+        version = versions[-choice]
+        lines = diff_versions(comm, page_file, None, version)
+        if lines is None:
+            print("Version file not found.")
+            return
+        print(f"\nChanges restoring {version['timestamp']} would make:")
+        print_diff(lines)
+        if input("Restore this version? (y/n): ").lower() != 'y':
+            print("Restore cancelled.")
+            return
+        if restore_page(comm, page_file, version) is not None:
+            print(f"Version {version['timestamp']} restored successfully.")
+        else:
+            print("Version file not found.")
+    except ValueError:
+        print("Invalid input.")
+
+SEARCH_SHARDS = 256
+SEARCH_FORMAT = 2
+SEARCH_LOG_MERGE_BYTES = 64 * 1024
+SEARCH_TOKEN = re.compile(r'\w+')
+search_shard_cache = {}
+
+def search_dir(comm):
+    return os.path.join(comm, '_search')
+
+def tokenize(text):
+    return SEARCH_TOKEN.findall(text.lower())
+
+def search_shard(token):
+    return zlib.crc32(token.encode()) % SEARCH_SHARDS
+
+def load_search_meta(comm):
+    path = os.path.join(search_dir(comm), '_meta.json')
+    if os.path.exists(path):
+        meta = json.load(open(path))
+        if meta.get('format') == SEARCH_FORMAT:
+            return meta
+    return None
+
+def page_postings(content):
+    postings = {}
+    for lineno, line in enumerate(content.split('\n'), 1):
+        for token in tokenize(line):
+            lines = postings.setdefault(token, [])
+            if not lines or lines[-1] != lineno:
+                lines.append(lineno)
+    return postings
+
+def search_shard_path(comm, shard):
+    return os.path.join(search_dir(comm), f'{shard:02x}.json')
+
+def search_log_path(shard_path, gen):
+    return f'{shard_path[:-len(".json")]}.{gen}.log'
+
+def search_forward_path(comm, page_file):
+    return os.path.join(search_dir(comm), '_fwd', page_file + '.json')
+
+def apply_search_delta(data, delta):
+    # Copy-on-write, so postings handed out earlier never change underneath a reader
+    data = dict(data)
+    for token, pages in delta.items():
+        token_pages = dict(data.get(token, {}))
+        for page_file, lines in pages.items():
+            if lines is None:
+                token_pages.pop(page_file, None)
+            else:
+                token_pages[page_file] = lines
+        if token_pages:
+            data[token] = token_pages
+        else:
+            data.pop(token, None)
+    return data
+
+def load_search_shard(path):
+    # A shard is a merged base plus an append-only log of deltas named after the base's generation
+    while True:
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        cached = search_shard_cache.get(path)
+        if not cached or cached[0] != mtime:
+            if mtime is None:
+                cached = (None, 0, 0, {})
+            else:
+                base = json.load(open(path))
+                cached = (mtime, base['gen'], 0, base['postings'])
+        mtime, gen, offset, data = cached
+        try:
+            with open(search_log_path(path, gen), 'rb') as f:
+                f.seek(offset)
+                tail = f.read()
+        except FileNotFoundError:
+            if os.path.exists(path) and os.stat(path).st_mtime_ns != mtime:
+                continue  # Merged while we were reading; start again from the new base
+            tail = b''
+        end = tail.rfind(b'\n') + 1
+        for line in tail[:end].splitlines():
+            try:
+                delta = json.loads(line)
+            except ValueError:
+                continue  # A delta torn by a crash
+            data = apply_search_delta(data, delta)
+        search_shard_cache[path] = (mtime, gen, offset + end, data)
+        return data
+
+def append_search_log(path, delta):
+    with open(path, 'ab+') as f:
+        size = f.tell()
+        if size:
+            f.seek(size - 1)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+        f.write(json.dumps(delta).encode() + b'\n')
+        return f.tell()
+
+def merge_search_shard(comm, shard):
+    with file_lock(os.path.join(comm, '_locks', '_search.lock')):
+        path = search_shard_path(comm, shard)
+        if not os.path.isdir(search_dir(comm)):
+            return
+        data = load_search_shard(path)
+        gen = search_shard_cache[path][1]
+        atomic_write(path, json.dumps({'gen': gen + 1, 'postings': data}), durable=False)
+        search_shard_cache[path] = (os.stat(path).st_mtime_ns, gen + 1, 0, data)
+        if os.path.exists(search_log_path(path, gen)):
+            os.remove(search_log_path(path, gen))
+
+def merge_search_shards(comm, shards):
+    for shard in shards:
+        merge_search_shard(comm, shard)
+
+@instrumented
+def update_search_index(comm, changes, meta=None):
+    # changes maps page name -> new content, or None when the page is gone
+    with file_lock(os.path.join(comm, '_locks', '_search.lock')):
+        meta = meta or load_search_meta(comm)
+        merges = apply_search_changes(comm, changes, meta)
+    if merges:
+        # Folding logs back into their base is the expensive part, so saves never wait for it
+        threading.Thread(target=merge_search_shards, args=(comm, merges)).start()
+
+def apply_search_changes(comm, changes, meta):
+    if meta is None:
+        return []
+    shard_updates = {}
+    os.makedirs(os.path.join(search_dir(comm), '_fwd'), exist_ok=True)
+    for page_file, content in changes.items():
+        forward_path = search_forward_path(comm, page_file)
+        if os.path.exists(forward_path):
+            old_tokens = json.load(open(forward_path))['tokens']
+            meta['docs'] -= 1
+            for token in old_tokens:
+                shard_updates.setdefault(search_shard(token), {}).setdefault(token, {})[page_file] = None
+        if content is None:
+            if os.path.exists(forward_path):
+                os.remove(forward_path)
+            continue
+        postings = page_postings(content)
+        for token, lines in postings.items():
+            shard_updates.setdefault(search_shard(token), {}).setdefault(token, {})[page_file] = lines
+        atomic_write(forward_path, json.dumps({'tokens': list(postings)}), durable=False)
+        meta['docs'] += 1
+
+    merges = []
+    for shard, updates in shard_updates.items():
+        path = search_shard_path(comm, shard)
+        load_search_shard(path)
+        gen = search_shard_cache[path][1]
+        log_size = append_search_log(search_log_path(path, gen), updates)
+        base_size = os.path.getsize(path) if os.path.exists(path) else 0
+        if log_size > max(SEARCH_LOG_MERGE_BYTES, base_size):
+            merges.append(shard)
+    atomic_write(os.path.join(search_dir(comm), '_meta.json'), json.dumps(meta), durable=False)
+    return merges
+
+def rebuild_search_index(comm):
+    if os.path.exists(search_dir(comm)):
+        shutil.rmtree(search_dir(comm))
+    search_shard_cache.clear()
+    changes = {}
+    for page_file in list_pages(comm):
+        with open(os.path.join(comm, page_file)) as f:
+            changes[page_file] = f.read()
+    update_search_index(comm, changes, {'docs': 0, 'format': SEARCH_FORMAT})
+
+def index_pages(comm, changes):
+    update_catalog_pages(comm, changes)
+    for page_file in changes:
+        invalidate_render_cache(os.path.join(comm, page_file))
+    update_search_index(comm, changes)
+    update_tag_index(comm, changes)
+    update_link_index(comm, changes)
+
+def extract_tags(content):
+    tags = []
+    in_code_block = False
+    for line in content.split('\n'):
+        if line.strip().startswith('```'):
+            in_code_block = not in_code_block
+        elif not in_code_block and line.startswith('#tag '):
+            tag = line[5:].strip()
+            if tag and tag not in tags:
+                tags.append(tag)
+    return tags
+
+def tag_index_path(comm):
+    return os.path.join(comm, '_tags.json')
+
+def write_tag_index(comm, index):
+    # Derived data that can be rebuilt from the pages, so it is replaced atomically but not fsynced
+    atomic_write(tag_index_path(comm), json.dumps(index), durable=False)
+
+def rebuild_tag_index(comm):
+    index = {'tags': {}, 'pages': {}}
+    for page_file in list_pages(comm):
+        with open(os.path.join(comm, page_file)) as f:
+            tags = extract_tags(f.read())
+        if tags:
+            index['pages'][page_file] = tags
+            for tag in tags:
+                index['tags'].setdefault(tag, []).append(page_file)
+    write_tag_index(comm, index)
+    return index
+
+def load_tag_index(comm):
+    path = tag_index_path(comm)
+    if os.path.exists(path):
+        return json.load(open(path))
+    return rebuild_tag_index(comm)
+
+@instrumented
+def update_tag_index(comm, changes):
+    if not os.path.exists(tag_index_path(comm)):
+        return
+    with file_lock(os.path.join(comm, '_locks', '_tags.lock')):
+        apply_tag_changes(comm, changes)
+
+def apply_tag_changes(comm, changes):
+    index = load_tag_index(comm)
+    changed = False
+    for page_file, content in changes.items():
+        old_tags = index['pages'].get(page_file, [])
+        new_tags = extract_tags(content) if content is not None else []
+        if old_tags == new_tags:
+            continue
+        changed = True
+        for tag in old_tags:
+            pages = index['tags'].get(tag, [])
+            if page_file in pages:
+                pages.remove(page_file)
+            if not pages:
+                index['tags'].pop(tag, None)
+        for tag in new_tags:
+            index['tags'].setdefault(tag, []).append(page_file)
+        if new_tags:
+            index['pages'][page_file] = new_tags
+        else:
+            index['pages'].pop(page_file, None)
+    if changed:
+        write_tag_index(comm, index)
+
+def pages_with_tag(comm, tag):
+    return load_tag_index(comm)['tags'].get(tag, [])
+
+def global_tag_index():
+    merged = {}
+    for comm in load_communities():
+        for tag, pages in load_tag_index(comm)['tags'].items():
+            merged.setdefault(tag, []).extend((comm, page_file) for page_file in pages)
+    return merged
+
+def find_tag():
+    merged = global_tag_index()
+    if not merged:
+        print("No tags found.")
+        return
+    print("Tags: " + ', '.join(f'{tag} ({len(pages)})' for tag, pages in sorted(merged.items())))
+    tag = input('Tag to look up: ').strip()
+    if tag not in merged:
+        print("Tag not found")
+        return
+    for comm, page_file in merged[tag]:
+        print(f'{comm[1:]}: {page_file}')
+
+def link_target(target):
+    # [[page]] stays in the community, [[Community:page]] points into another one
+    comm_name, sep, page = target.partition(':')
+    if sep and comm_name.strip() and page.strip():
+        return comm_name.strip(), page_name(page.strip())
+    return None, page_name(target.strip())
+
+def link_key(target):
+    comm_name, page_file = link_target(target)
+    return page_file if comm_name is None else f'{comm_name}:{page_file}'
+
+def sub_links(content, repl):
+    # Links inside code blocks and inline code are text, as the renderer shows them
+    out = []
+    in_code_block = False
+    for line in content.split('\n'):
+        if line.strip().startswith('```'):
+            in_code_block = not in_code_block
+        elif not in_code_block and '[[' in line:
+            parts = line.split('`')
+            line = '`'.join(WIKI_LINK.sub(repl, part) if i % 2 == 0 else part for i, part in enumerate(parts))
+        out.append(line)
+    return '\n'.join(out)
+
+def extract_links(content):
+    links = []
+
+    def collect(m):
+        key = link_key(m.group(1))
+        if key not in links:
+            links.append(key)
+        return m.group(0)
+
+    sub_links(content, collect)
+    return links
+
+def link_index_path(comm):
+    return os.path.join(comm, '_links.json')
+
+def write_link_index(comm, index):
+    atomic_write(link_index_path(comm), json.dumps(index), durable=False)
+
+def rebuild_link_index(comm):
+    index = {'links': {}, 'backlinks': {}}
+    for page_file in list_pages(comm):
+        with open(os.path.join(comm, page_file)) as f:
+            links = extract_links(f.read())
+        if links:
+            index['links'][page_file] = links
+            for key in links:
+                index['backlinks'].setdefault(key, []).append(page_file)
+    write_link_index(comm, index)
+    return index
+
+def load_link_index(comm):
+    path = link_index_path(comm)
+    if os.path.exists(path):
+        return json.load(open(path))
+    return rebuild_link_index(comm)
+
+@instrumented
+def update_link_index(comm, changes):
+    if not os.path.exists(link_index_path(comm)):
+        return
+    with file_lock(os.path.join(comm, '_locks', '_links.lock')):
+        apply_link_changes(comm, changes)
+
+def apply_link_changes(comm, changes):
+    index = load_link_index(comm)
+    changed = False
+    for page_file, content in changes.items():
+        old_links = index['links'].get(page_file, [])
+        new_links = extract_links(content) if content is not None else []
+        if old_links == new_links:
+            continue
+        changed = True
+        for key in old_links:
+            pages = index['backlinks'].get(key, [])
+            if page_file in pages:
+                pages.remove(page_file)
+            if not pages:
+                index['backlinks'].pop(key, None)
+        for key in new_links:
+            index['backlinks'].setdefault(key, []).append(page_file)
+        if new_links:
+            index['links'][page_file] = new_links
+        else:
+            index['links'].pop(page_file, None)
+    if changed:
+        write_link_index(comm, index)
+
+def pages_linking_to(comm, page_file):
+    # "What links here": one lookup per community, including [[Community:page]] links from elsewhere
+    found = []
+    for other in load_communities():
+        backlinks = load_link_index(other)['backlinks']
+        keys = [f'{comm[1:]}:{page_file}'] + ([page_file] if other == comm else [])
+        for key in keys:
+            found.extend((other, source) for source in backlinks.get(key, []) if (other, source) not in found)
+    return found
+
+def orphan_pages(comm):
+    linked = set()
+    for other in load_communities():
+        for key in load_link_index(other)['backlinks']:
+            comm_name, page_file = link_target(key)
+            if comm_name == comm[1:] or (comm_name is None and other == comm):
+                linked.add(page_file)
+    return [page_file for page_file in list_pages(comm) if page_file not in linked]
+
+def missing_link_targets(comm):
+    pages = set(list_pages(comm))
+    return {key: sources for key, sources in load_link_index(comm)['backlinks'].items()
+            if ':' not in key and key not in pages}
+
+def relink_pages(comm, old_name, new_name):
+    # Rewrites every [[old]] (and [[Community:old]] elsewhere) to the new name, one batch per community
+    referrers = {}
+    for other, source in pages_linking_to(comm, old_name):
+        referrers.setdefault(other, []).append(source)
+    old_keys = {f'{comm[1:]}:{old_name}'}
+    rewritten = 0
+    for other, sources in referrers.items():
+        keys = old_keys | ({old_name} if other == comm else set())
+
+        def relink(m):
+            comm_name, _ = link_target(m.group(1))
+            if link_key(m.group(1)) not in keys:
+                return m.group(0)
+            target = new_name if m.group(1).strip().endswith('.md') else new_name.removesuffix('.md')
+            if comm_name is not None:
+                target = f'{comm_name}:{target}'
+            return f'[[{target}|{m.group(2)}]]' if m.group(2) is not None else f'[[{target}]]'
+
+        entries = []
+        changes = {}
+        with contextlib.ExitStack() as stack, durability_batch():
+            for source in sources:
+                stack.enter_context(page_lock(other, source))
+            for source in sources:
+                path = os.path.join(other, source)
+                if not os.path.exists(path):
+                    continue
+                with open(path) as f:
+                    content = f.read()
+                new_content = sub_links(content, relink)
+                if new_content == content:
+                    continue
+                last = last_page_version(other, source)
+                pre_digest = store_blob(other, content, last.get('blob') if last else None)
+                if not last or last.get('blob') != pre_digest:
+                    entries.append(version_entry(source, pre_digest, 'relink_pre'))
+                atomic_write(path, new_content)
+                entries.append(version_entry(source, store_blob(other, new_content, pre_digest), 'relink_post'))
+                changes[source] = new_content
+            if entries:
+                append_version_entries(other, entries)
+        if changes:
+            index_pages(other, changes)
+        rewritten += len(changes)
+    return rewritten
+
+def show_backlinks(comm, page_file):
+    found = pages_linking_to(comm, page_file)
+    if not found:
+        print(f"Nothing links to {page_file}.")
+    for other, source in found:
+        print(source if other == comm else f'{other[1:]}: {source}')
+
+def link_report(comm):
+    orphans = orphan_pages(comm)
+    print(ansi(f"Orphan pages ({len(orphans)}):", '1'))
+    for page_file in orphans:
+        print(f'  {page_file}')
+    missing = missing_link_targets(comm)
+    print(ansi(f"Links to missing pages ({len(missing)}):", '1'))
+    for key, sources in sorted(missing.items()):
+        print(f"  {key} <- {', '.join(sources)}")
+    page_file = input_optional('Show what links to page')
+    if page_file:
+        show_backlinks(comm, page_name(page_file))
+
+def parse_search_query(query):
+    phrases = [tokenize(p) for p in re.findall(r'"([^"]*)"', query)]
+    terms = tokenize(re.sub(r'"[^"]*"', ' ', query))
+    return terms, [p for p in phrases if p]
+
+def line_has_phrase(line, phrase):
+    tokens = tokenize(line)
+    n = len(phrase)
+    return any(tokens[i:i+n] == phrase for i in range(len(tokens) - n + 1))
+
+@instrumented
+def search_pages(comm, query, limit=20):
+    meta = load_search_meta(comm)
+    if meta is None:
+        rebuild_search_index(comm)
+        meta = load_search_meta(comm)
+    terms, phrases = parse_search_query(query)
+    wanted = list(dict.fromkeys(terms + [t for p in phrases for t in p]))
+    if not wanted:
+        return []
+
+    postings = {}
+    for token in wanted:
+        postings[token] = load_search_shard(search_shard_path(comm, search_shard(token))).get(token, {})
+    candidates = None
+    for token in sorted(wanted, key=lambda t: len(postings[t])):
+        pages = set(postings[token])
+        candidates = pages if candidates is None else candidates & pages
+        if not candidates:
+            return []
+
+    results = []
+    for page_file in candidates:
+        hit_lines = set()
+        score = 0.0
+        for token in wanted:
+            lines = postings[token][page_file]
+            df = len(postings[token])
+            idf = math.log(1 + (meta['docs'] - df + 0.5) / (df + 0.5))
+            score += idf * len(lines) * 2.2 / (len(lines) + 1.2)
+            hit_lines.update(lines)
+        if phrases:
+            phrase_lines = None
+            for phrase in phrases:
+                lines = set(postings[phrase[0]][page_file])
+                for token in phrase[1:]:
+                    lines &= set(postings[token][page_file])
+                phrase_lines = lines if phrase_lines is None else phrase_lines | lines
+            if not phrase_lines:
+                continue
+            with open(os.path.join(comm, page_file)) as f:
+                page_lines = f.read().split('\n')
+            phrase_lines = [n for n in sorted(phrase_lines)
+                            if n <= len(page_lines) and all(line_has_phrase(page_lines[n-1], p) for p in phrases)]
+            if not phrase_lines:
+                continue
+            score *= 1 + len(phrase_lines)
+            hit_lines = set(phrase_lines)
+        results.append((score, page_file, sorted(hit_lines)))
+
+    results.sort(key=lambda r: (-r[0], r[1]))
+    return results[:limit]
+
+def search_community(comm):
+    query = input('Search (use "quotes" for phrases): ').strip()
+    results = search_pages(comm, query)
+    if not results:
+        print("No matching pages.")
+        return
+    for i, (score, page_file, lines) in enumerate(results):
+        print(f"{i+1}. {page_file} (score {score:.2f})")
+        with open(os.path.join(comm, page_file)) as f:
+            page_lines = f.read().split('\n')
+        for lineno in lines[:3]:
+            if lineno <= len(page_lines):
+                print(f"   L{lineno}: {page_lines[lineno-1].strip()}")
 
-    version_log = os.path.join(comm, '_versions', '_version_log.json')
-    if os.path.exists(version_log):
-        log_data = json.load(open(version_log))
-    else:
-        log_data = {}
+def community_path(name):
+    return name if name.startswith('.') else f'.{name}'
 
-    if page_file not in log_data:
-        log_data[page_file] = []
+def page_name(name):
+    return name if name.endswith('.md') else name + '.md'
 
-    log_data[page_file].append({
-        'timestamp': timestamp,
-        'hash': content_hash,
-        'operation': operation,
-        'version_file': f"{timestamp}_{content_hash}_{operation}.md"
-    })
+class PageConflictError(Exception):
+    def __init__(self, page_file, current):
+        super().__init__(f'{page_file} was changed by another writer')
+        self.page_file = page_file
+        self.current = current
 
-    with open(version_log, 'w') as f:
-        json.dump(log_data, f, indent=2)
+    def __reduce__(self):
+        # Raised inside pool workers, so it has to survive pickling
+        return (PageConflictError, (self.page_file, self.current))
 
-def get_page_info(comm, page_file):
-    info = {
-        'name': page_file,
-        'size': os.path.getsize(os.path.join(comm, page_file)),
-        'created': datetime.fromtimestamp(os.path.getctime(os.path.join(comm, page_file))).strftime("%Y-%m-%d %H:%M:%S"),
-        'modified': datetime.fromtimestamp(os.path.getmtime(os.path.join(comm, page_file))).strftime("%Y-%m-%d %H:%M:%S"),
-        'versions': 0
-    }
+def page_digest(content):
+    # '' stands for a page that does not exist yet
+    return content_digest(content) if content is not None else ''
 
-    version_log = os.path.join(comm, '_versions', '_version_log.json')
-    if os.path.exists(version_log):
-        log_data = json.load(open(version_log))
-        if page_file in log_data:
-            info['versions'] = len(log_data[page_file])
-            info['last_version'] = log_data[page_file][-1]['timestamp'] if log_data[page_file] else 'None'
+@instrumented
+def write_page(comm, page_file, content, operation, expected_digest=None):
+    # With expected_digest the save is a compare-and-swap against the content the writer started from
+    path = os.path.join(comm, page_file)
+    with page_lock(comm, page_file):
+        current = None
+        if os.path.exists(path):
+            with open(path) as f:
+                current = f.read()
+        if expected_digest is not None and page_digest(current) != expected_digest:
+            raise PageConflictError(page_file, current)
+        if current == content:
+            # Saving unchanged content touches nothing, so the page's mtime and caches stay valid
+            return
+        with durability_batch():
+            atomic_write(path, content)
+            create_version(comm, page_file, content, operation)
+        index_pages(comm, {page_file: content})
 
-    return info
+@instrumented
+def get_page(comm, page_file):
+    path = os.path.join(comm, page_file)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read()
 
-def show_page_info(comm, page_file):
-    info = get_page_info(comm, page_file)
-    print(f"\nPage Information: {info['name']}")
-    print(f"Size: {info['size']} bytes")
-    print(f"Created: {info['created']}")
-    print(f"Last Modified: {info['modified']}")
-    print(f"Version History: {info['versions']} saved versions")
-    if info['versions'] > 0:
-        print(f"Last Version: {info['last_version']}")
+@instrumented
+def put_page(comm, page_file, content, expected_digest=None):
+    with page_lock(comm, page_file):
+        current = get_page(comm, page_file)
+        if expected_digest is not None and page_digest(current) != expected_digest:
+            raise PageConflictError(page_file, current)
+        if current == content:
+            return
+        if current is not None:
+            create_version(comm, page_file, current, 'edit_pre')
+        write_page(comm, page_file, content, 'edit_post')
 
-def view_version_history(comm, page_file):
-    version_log = os.path.join(comm, '_versions', '_version_log.json')
-    if not os.path.exists(version_log):
-        print("No version history available.")
-        return
+def merge_contents(base, mine, theirs):
+    # Three-way line merge; overlapping changes are kept with conflict markers
+    base_lines, mine_lines, their_lines = base.split('\n'), mine.split('\n'), theirs.split('\n')
 
-    log_data = json.load(open(version_log))
-    if page_file not in log_data or not log_data[page_file]:
-        print("No version history for this page.")
-        return
+    def changes(other):
+        return [(i1, i2, other[j1:j2]) for tag, i1, i2, j1, j2 in
+                difflib.SequenceMatcher(None, base_lines, other).get_opcodes() if tag != 'equal']
 
-    print(f"\nVersion History for {page_file}:")
-    for i, version in enumerate(reversed(log_data[page_file])):
-        print(f"{i+1}. {version['timestamp']} - {version['operation']} - Hash: {version['hash']}")
+    hunks = sorted([(i1, i2, lines, 'mine') for i1, i2, lines in changes(mine_lines)] +
+                   [(i1, i2, lines, 'theirs') for i1, i2, lines in changes(their_lines)],
+                   key=lambda hunk: (hunk[0], hunk[1]))
+    merged = []
+    pos = 0
+    i = 0
+    while i < len(hunks):
+        start, end, lines, side = hunks[i]
+        group = [hunks[i]]
+        i += 1
+        while i < len(hunks) and (hunks[i][0] < end or (hunks[i][0] == start == end == hunks[i][1])):
+            end = max(end, hunks[i][1])
+            group.append(hunks[i])
+            i += 1
+        merged.extend(base_lines[pos:start])
+        sides = {hunk[3] for hunk in group}
+        if len(sides) == 1:
+            for hunk_start, hunk_end, hunk_lines, _ in group:
+                merged.extend(hunk_lines)
+        else:
+            def side_text(name):
+                out = base_lines[start:end]
+                for hunk_start, hunk_end, hunk_lines, hunk_side in reversed([h for h in group if h[3] == name]):
+                    out[hunk_start-start:hunk_end-start] = hunk_lines
+                return out
+            mine_side, their_side = side_text('mine'), side_text('theirs')
+            if mine_side == their_side:
+                merged.extend(mine_side)
+            else:
+                merged.extend(['<<<<<<< yours'] + mine_side + ['======='] + their_side + ['>>>>>>> theirs'])
+        pos = end
+    merged.extend(base_lines[pos:])
+    return '\n'.join(merged)
 
-def restore_version(comm, page_file):
-    version_log = os.path.join(comm, '_versions', '_version_log.json')
-    if not os.path.exists(version_log):
-        print("No version history available.")
-        return
+@instrumented
+def render_page(comm, page_file):
+    version, tokens, _ = expanded_tokens(comm, page_file)
+    return render_tokens(tokens, version)
 
-    log_data = json.load(open(version_log))
-    if page_file not in log_data or not log_data[page_file]:
-        print("No version history for this page.")
-        return
+@instrumented
+def restore_page(comm, page_file, version):
+    content = read_version(comm, page_file, version)
+    if content is not None:
+        write_page(comm, page_file, content, 'restored')
+    return content
 
-    view_version_history(comm, page_file)
-    try:
-        choice = int(input("\nSelect version to restore (number): "))
-        if choice < 1 or choice > len(log_data[page_file]):
-            print("Invalid selection.")
-            return
+IMPORT_BATCH_SIZE = 500
 
-        version = list(reversed(log_data[page_file]))[choice-1]
-        version_path = os.path.join(comm, '_versions', page_file, version['version_file'])
+def import_page_name(rel_path):
+    parts = [part for part in rel_path.replace('\\', '/').split('/') if part not in ('', '.', '..')]
+    return '_'.join(parts).lstrip('_.')
 
-        if os.path.exists(version_path):
-            with open(version_path, 'r') as f:
-                content = f.read()
+def iter_import_source(source):
+    # Yields (relative path, content) for every .md file in a directory tree or tar archive
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith('.md'):
+                    path = os.path.join(root, name)
+                    with open(path, encoding='utf-8', errors='replace') as f:
+                        yield os.path.relpath(path, source), f.read()
+    else:
+        with tarfile.open(source, 'r:*') as archive:
+            for member in archive:
+                if member.isfile() and member.name.endswith('.md'):
+                    yield member.name, archive.extractfile(member).read().decode('utf-8', 'replace')
 
-            current_path = os.path.join(comm, page_file)
-            with open(current_path, 'w') as f:
+def commit_import_batch(comm, batch, progress_path):
+    entries = []
+    changes = {}
+    with contextlib.ExitStack() as stack, durability_batch():
+        for page_file in sorted({page_file for _, page_file, _ in batch}):
+            stack.enter_context(page_lock(comm, page_file))
+        for rel_path, page_file, content in batch:
+            current = get_page(comm, page_file)
+            if current == content:
+                # Re-importing an unchanged page adds neither a write nor a version
+                continue
+            last = last_page_version(comm, page_file)
+            base = last.get('blob') if last else None
+            if current is not None and base != content_digest(current):
+                # Edits made since the last version would otherwise vanish from the history
+                base = store_blob(comm, current, base)
+                entries.append(version_entry(page_file, base, 'edit_pre'))
+            with atomic_open(os.path.join(comm, page_file)) as f:
                 f.write(content)
+            digest = store_blob(comm, content, base)
+            entries.append(version_entry(page_file, digest, 'import'))
+            changes[page_file] = content
+        if entries:
+            append_version_entries(comm, entries)
+    if changes:
+        index_pages(comm, changes)
+    # Only recorded once the batch is journaled, so an interrupted import redoes at most one batch
+    append_durable(progress_path, ''.join(rel_path + '\n' for rel_path, _, _ in batch))
+    return len(batch) - len(changes)
 
-            create_version(comm, page_file, content, 'restored')
-            print(f"Version {version['timestamp']} restored successfully.")
-        else:
-            print("Version file not found.")
-    except ValueError:
-        print("Invalid input.")
+@instrumented
+def import_tree(comm, source, batch_size=IMPORT_BATCH_SIZE):
+    progress_path = os.path.join(comm, '_import.progress')
+    done = set()
+    if os.path.exists(progress_path):
+        with open(progress_path) as f:
+            done = set(f.read().splitlines())
+        print(f'Resuming import, {len(done)} pages already imported.')
+
+    imported = 0
+    unchanged = 0
+    batch = []
+    for rel_path, content in iter_import_source(source):
+        if rel_path in done:
+            continue
+        page_file = import_page_name(rel_path)
+        if not page_file.endswith('.md') or page_file == '.md':
+            continue
+        batch.append((rel_path, page_file, content))
+        if len(batch) >= batch_size:
+            unchanged += commit_import_batch(comm, batch, progress_path)
+            imported += len(batch)
+            batch = []
+            print(f'\rImported {imported} pages', end='', flush=True)
+    if batch:
+        unchanged += commit_import_batch(comm, batch, progress_path)
+        imported += len(batch)
+    if os.path.exists(progress_path):
+        os.remove(progress_path)
+    print(f'\rImported {imported} pages from {source}, {unchanged} unchanged.')
+    return imported
 
 def create_community():
     name = input('Community Name: ').strip()
@@ -252,7 +2247,18 @@ def delete_community():
     for i, c in enumerate(communities):
         print(f'{i+1}. {c[1:]}')
     idx = int(input('Select community to delete: ')) - 1
-    shutil.rmtree(communities[idx])
+    comm = communities[idx]
+    inbound = [(other, source, key) for other in communities if other != comm
+               for key, sources in load_link_index(other)['backlinks'].items() if key.startswith(f'{comm[1:]}:')
+               for source in sources]
+    if inbound:
+        print(f'{len(inbound)} links from other communities point into {comm[1:]}:')
+        for other, source, key in inbound[:10]:
+            print(f'  {other[1:]}: {source} -> {key}')
+        if input('Delete anyway? (y/n): ').lower() != 'y':
+            print('Cancelled.')
+            return
+    shutil.rmtree(comm)
     print('Deleted.')
 
 def rename_community():
@@ -272,6 +2278,7 @@ def rename_community():
     os.rename(communities[idx], f'.{new_name}')
     print('Community renamed.')
 
+@instrumented
 def rename_page(comm):
     pages = list_pages(comm)
     if not pages:
@@ -293,20 +2300,26 @@ def rename_page(comm):
     old_path = os.path.join(comm, old_name)
     new_path = os.path.join(comm, new_name)
 
-    if os.path.exists(old_path):
-        with open(old_path, 'r') as f:
-            content = f.read()
-        create_version(comm, old_name, content, 'rename_old')
+    with page_lock(comm, old_name), page_lock(comm, new_name):
+        if os.path.exists(old_path):
+            with open(old_path, 'r') as f:
+                content = f.read()
+            create_version(comm, old_name, content, 'rename_old')
 
-    os.rename(old_path, new_path)
+        os.rename(old_path, new_path)
 
     if os.path.exists(new_path):
         with open(new_path, 'r') as f:
             content = f.read()
         create_version(comm, new_name, content, 'rename_new')
+        index_pages(comm, {old_name: None, new_name: content})
 
     print('Page renamed.')
+    referrers = pages_linking_to(comm, old_name)
+    if referrers and input(f'{len(referrers)} pages link to {old_name}. Point them at {new_name}? (y/n): ').lower() == 'y':
+        print(f'Updated links in {relink_pages(comm, old_name, new_name)} pages.')
 
+@instrumented
 def edit_page(comm):
     pages = list_pages(comm)
     print('Pages:')
@@ -319,9 +2332,11 @@ def edit_page(comm):
         filename = choice if choice.endswith('.md') else choice + '.md'
     path = os.path.join(comm, filename)
     content = ''
+    base_digest = ''
     if os.path.exists(path):
         with open(path) as f:
             content = f.read()
+        base_digest = content_digest(content)
         create_version(comm, filename, content, 'edit_pre')
     print('--- Current Content ---')
     print(render_markdown(content))
@@ -348,26 +2363,29 @@ def edit_page(comm):
             continue
         new_lines.append(line)
     new_content = '\n'.join(new_lines)
-    with open(path, 'w') as f:
-        f.write(new_content)
-    create_version(comm, filename, new_content, 'edit_post')
     save_edit_macros(comm, edit_macros)
+    while True:
+        try:
+            write_page(comm, filename, new_content, 'edit_post', base_digest)
+            break
+        except PageConflictError as conflict:
+            print(f'{filename} was changed by someone else while you were editing.')
+            action = input('(m)erge, (o)verwrite or (c)ancel: ').strip().lower()
+            if action == 'm':
+                new_content = merge_contents(content, new_content, conflict.current or '')
+                content = conflict.current or ''
+                base_digest = page_digest(conflict.current)
+                if '<<<<<<< yours' in new_content:
+                    print('Merged with conflicts; look for <<<<<<< markers in the page.')
+            elif action == 'o':
+                base_digest = None
+            else:
+                print('Edit discarded.')
+                return
     print('Saved.')
 
-def replay_macro(comm, macro_name, page_file):
-    edit_macros = load_edit_macros(comm)
-    if macro_name not in edit_macros:
-        print("Macro not found.")
-        return
-    path = os.path.join(comm, page_file)
-    lines = []
-    if os.path.exists(path):
-        with open(path) as f:
-            content = f.read()
-        lines = content.split('\n')
-        create_version(comm, page_file, content, 'macro_pre')
-
-    for cmd in edit_macros[macro_name]:
+def apply_edit_macro(lines, commands):
+    for cmd in commands:
         if cmd.startswith(':insert '):
             lines.append(cmd[8:].strip())
         elif cmd.startswith(':delete '):
@@ -386,13 +2404,144 @@ def replay_macro(comm, macro_name, page_file):
                         lines[idx] = parts[1]
                 except:
                     continue
+    return lines
+
+@instrumented
+def replay_macro(comm, macro_name, page_file):
+    edit_macros = load_edit_macros(comm)
+    if macro_name not in edit_macros:
+        print("Macro not found.")
+        return
+    path = os.path.join(comm, page_file)
+    content = None
+    with page_lock(comm, page_file):
+        if os.path.exists(path):
+            with open(path) as f:
+                content = f.read()
 
-    new_content = '\n'.join(lines)
-    with open(path, 'w') as f:
-        f.write(new_content)
-    create_version(comm, page_file, new_content, 'macro_post')
+        new_content = '\n'.join(apply_edit_macro(content.split('\n') if content is not None else [], edit_macros[macro_name]))
+        if new_content == content:
+            # Idempotent macros (replacing a line with itself, say) leave the page and its history alone
+            print(f'Macro "{macro_name}" left {page_file} unchanged.')
+            return
+        if content is not None:
+            create_version(comm, page_file, content, 'macro_pre')
+        write_page(comm, page_file, new_content, 'macro_post')
     print(f'Macro "{macro_name}" applied to {page_file}.')
 
+def replay_macro_worker(comm, page_file, commands):
+    # Runs in a pool process: rewrites the page and stores its blobs, the parent journals the entries
+    path = os.path.join(comm, page_file)
+    with page_lock(comm, page_file):
+        with open(path) as f:
+            content = f.read()
+        new_content = '\n'.join(apply_edit_macro(content.split('\n'), commands))
+        if new_content == content:
+            return [], None
+        last = last_page_version(comm, page_file)
+        with durability_batch():
+            pre_digest = store_blob(comm, content, last.get('blob') if last else None)
+            post_digest = store_blob(comm, new_content, pre_digest)
+            atomic_write(path, new_content)
+    entries = [version_entry(page_file, post_digest, 'macro_post')]
+    if not last or last.get('blob') != pre_digest:
+        entries.insert(0, version_entry(page_file, pre_digest, 'macro_pre'))
+    return entries, new_content
+
+def select_pages(comm, pattern):
+    if pattern.startswith('tag:'):
+        return pages_with_tag(comm, pattern[4:].strip())
+    return [p for p in list_pages(comm) if fnmatch.fnmatch(p, pattern)]
+
+@instrumented
+def batch_replay_macro(comm, macro_name, pattern, workers=None):
+    edit_macros = load_edit_macros(comm)
+    if macro_name not in edit_macros:
+        print("Macro not found.")
+        return None
+    pages = select_pages(comm, pattern)
+    if not pages:
+        print("No pages match.")
+        return None
+
+    entries = []
+    changes = {}
+    failures = {}
+    unchanged = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=forget_catalog_connections) as pool:
+        futures = {pool.submit(replay_macro_worker, comm, p, edit_macros[macro_name]): p for p in pages}
+        for done, future in enumerate(as_completed(futures), 1):
+            page_file = futures[future]
+            try:
+                page_entries, new_content = future.result()
+                if new_content is None:
+                    unchanged += 1
+                else:
+                    entries.extend(page_entries)
+                    changes[page_file] = new_content
+            except Exception as e:
+                failures[page_file] = str(e)
+            print(f'\r[{done}/{len(pages)}] {page_file}'.ljust(60), end='', flush=True)
+    print()
+
+    # One journal append and one index pass for the whole batch
+    if entries:
+        append_version_entries(comm, entries)
+        index_pages(comm, changes)
+    print(f'Macro "{macro_name}" applied to {len(changes)} pages, {unchanged} unchanged, {len(failures)} failed.')
+    for page_file, error in failures.items():
+        print(f'  {page_file}: {error}')
+    return changes, failures
+
+def batch_replay_prompt(comm):
+    macro_name = input("Enter macro name to replay: ").strip()
+    pattern = input("Page glob or tag:<name> (e.g. *.md): ").strip() or '*.md'
+    batch_replay_macro(comm, macro_name, pattern)
+
+STREAM_VIEW_THRESHOLD = 256 * 1024
+
+def iter_page_lines(path, offset=0):
+    # Yields (line, offset after the line) so a viewer can resume from any line boundary
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for raw in iter(f.readline, b''):
+            offset += len(raw)
+            yield raw.rstrip(b'\r\n').decode('utf-8', 'replace'), offset
+
+@instrumented
+def stream_page(page_file, path):
+    height = max(shutil.get_terminal_size().lines - 2, 1)
+    size = os.path.getsize(path)
+    # Start offset and code-block state of every screen shown so far, so k can page back
+    checkpoints = [(0, False)]
+    screen = 0
+    while True:
+        offset, in_code_block = checkpoints[screen]
+        lines = []
+        end = offset
+        for line, end in iter_page_lines(path, offset):
+            lines.append(line)
+            if len(lines) == height:
+                break
+        clear()
+        print(render_tokens(markdown_tokens(lines, in_code_block)))
+        percent = end * 100 // size if size else 100
+        print(ansi(f'--- {page_file} {percent}% (j/k to page, q to go back) ---', '0;36'))
+
+        key = readchar.readkey()
+        if key in ('j', ' ', '\x1b[B') and end < size:
+            if screen + 1 == len(checkpoints):
+                for line in lines:
+                    if line.strip().startswith('```'):
+                        in_code_block = not in_code_block
+                checkpoints.append((end, in_code_block))
+            screen += 1
+        elif key in ('k', '\x1b[A'):
+            screen = max(screen - 1, 0)
+        elif key == 'q':
+            break
+
+@instrumented
 def view_page(comm):
     pages = list_pages(comm)
     if not pages:
@@ -410,34 +2559,729 @@ def view_page(comm):
         print("Page not found")
         return
     content_path = os.path.join(comm, page_file)
-    for line in open(content_path).read().split('\n'):
-        if line.startswith('@replay '):
-            replay_macro(comm, line[8:].strip(), page_file)
-    with open(content_path) as f:
+    # Viewing never writes: @replay macros are applied to the rendered copy only
+    if os.path.getsize(content_path) > STREAM_VIEW_THRESHOLD:
+        # Streamed pages are shown as stored, with their @replay lines as markers
+        stream_page(page_file, content_path)
+        replays = [line[8:].strip() for line, _ in iter_page_lines(content_path) if line.startswith('@replay ')]
+    else:
+        version, tokens, _ = expanded_tokens(comm, page_file)
         print(f'--- {page_file} ---')
-        print(render_markdown(f.read()))
+        print(render_tokens(tokens, version))
+        replays = [value.strip() for kind, value in page_tokens(content_path) if kind == 'replay']
+    if replays and input("Apply this page's @replay macros to it permanently? (y/n): ").lower() == 'y':
+        apply_replays(comm, page_file)
 
-def export_posix(comm):
+def apply_replays(comm, page_file):
+    # The old view behaviour, now only on request: each @replay macro rewrites the stored page
+    path = os.path.join(comm, page_file)
+    with page_lock(comm, page_file):
+        replays = [line[8:].strip() for line, _ in iter_page_lines(path) if line.startswith('@replay ')]
+        for macro_name in replays:
+            replay_macro(comm, macro_name, page_file)
+    return replays
+
+def sh_quote(text):
+    return "'" + text.replace("'", "'\\''") + "'"
+
+def export_page_block(page_file, content, digest):
+    # The quoted heredoc delimiter carries the page hash, so page text can never end the block early
+    delimiter = f'FIREWIKI_EOF_{digest[:24]}'
+    return (f'{sh_quote(page_file)}) cat <<\'{delimiter}\'\n{content}\n{delimiter}\n;;\n').encode()
+
+def load_export_manifest(filename):
+    manifest_path = filename + '.manifest.json'
+    if not (os.path.exists(manifest_path) and os.path.exists(filename)):
+        return {'pages': {}}
+    manifest = json.load(open(manifest_path))
+    if manifest.get('script_size') != os.path.getsize(filename):
+        return {'pages': {}}
+    return manifest
+
+@instrumented
+def export_posix(comm, pattern=None, filename=None):
     meta = read_metadata(comm)
-    filename = f'{comm[1:]}.sh'
-    pages = list_pages(comm)
-    with open(filename, 'w') as f:
-        f.write('#!/bin/sh\n')
-        f.write(f'echo "Community: {meta.get("Name","")}"\n')
-        f.write(f'echo "Genre: {meta.get("Genre","")}"\n')
-        f.write(f'echo "Description: {meta.get("Description","")}"\n')
-        f.write(f'echo "Age Restriction: {meta.get("AgeRestriction","")}"\n')
-        f.write('echo ""\n')
-        f.write('echo "Pages:"\n')
-        for i, p in enumerate(pages):
-            f.write(f'echo "{i+1}. {p}"\n')
-        f.write('read -p "Select page number: " pg\n')
-        f.write('case $pg in\n')
-        for i, p in enumerate(pages):
-            f.write(f'{i+1}) echo "--- {p} ---"; cat .{comm[1:]}/{p} ;; \n')
-        f.write('*) echo "Invalid selection";; esac\n')
+    filename = filename or f'{comm[1:]}.sh'
+    pages = select_pages(comm, pattern) if pattern else list_pages(comm)
+    previous = load_export_manifest(filename)
+
+    header = '#!/bin/sh\n'
+    for label, key in (('Community', 'Name'), ('Genre', 'Genre'), ('Description', 'Description'), ('Age Restriction', 'AgeRestriction')):
+        value = meta.get(key, '')
+        header += f'echo {sh_quote(f"{label}: {value}")}\n'
+    header += 'show_page() {\ncase $1 in\n'
+    footer = '*) echo "Invalid selection";;\nesac\n}\necho ""\necho "Pages:"\n'
+    for i, p in enumerate(pages):
+        footer += f'echo {sh_quote(f"{i+1}. {p}")}\n'
+    footer += 'printf "Select page number: "\nread pg\ncase $pg in\n'
+    for i, p in enumerate(pages):
+        footer += f'{i+1}) echo {sh_quote(f"--- {p} ---")}; show_page {sh_quote(p)} ;;\n'
+    footer += '*) echo "Invalid selection";; esac\n'
+
+    # Unchanged pages (same size and mtime, or same hash) are copied from the previous script without re-encoding
+    plan = []
+    for page_file in pages:
+        st = os.stat(os.path.join(comm, page_file))
+        old = previous['pages'].get(page_file)
+        if old and old['size'] == st.st_size and old['mtime_ns'] == st.st_mtime_ns:
+            plan.append((page_file, st, old['hash'], None))
+            continue
+        with open(os.path.join(comm, page_file)) as f:
+            content = f.read()
+        plan.append((page_file, st, content_digest(content), content))
+
+    unchanged = (previous.get('header') == content_digest(header + footer)
+                 and list(previous['pages']) == pages
+                 and all(previous['pages'][p]['hash'] == digest for p, _, digest, _ in plan))
+    if unchanged:
+        print(f'{filename} is up to date, nothing exported.')
+        return
+
+    manifest = {'header': content_digest(header + footer), 'pages': {}}
+    rewritten = 0
+    old_script = open(filename, 'rb') if previous['pages'] else None
+    try:
+        with atomic_open(filename, 'wb') as f:
+            f.write(header.encode())
+            offset = len(header.encode())
+            for page_file, st, digest, content in plan:
+                old = previous['pages'].get(page_file)
+                if old and old['hash'] == digest:
+                    old_script.seek(old['offset'])
+                    block = old_script.read(old['length'])
+                else:
+                    if content is None:
+                        with open(os.path.join(comm, page_file)) as page:
+                            content = page.read()
+                    block = export_page_block(page_file, content, digest)
+                    rewritten += 1
+                f.write(block)
+                manifest['pages'][page_file] = {'hash': digest, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                                                'offset': offset, 'length': len(block)}
+                offset += len(block)
+            f.write(footer.encode())
+            offset += len(footer.encode())
+    finally:
+        if old_script:
+            old_script.close()
+    manifest['script_size'] = offset
+    atomic_write(filename + '.manifest.json', json.dumps(manifest))
     os.chmod(filename, 0o755)
-    print(f'Exported interactive POSIX script: {filename}')
+    print(f'Exported interactive POSIX script: {filename} ({rewritten} of {len(pages)} pages re-encoded)')
+
+HTML_RENDERER_VERSION = 5
+HTML_STYLE = """body{font-family:sans-serif;max-width:50em;margin:2em auto;padding:0 1em;line-height:1.5}
+pre,code{background:#222;color:#eee;padding:0 .2em}pre{padding:.5em;overflow-x:auto}
+blockquote{color:#936;border-left:3px solid #936;margin:0;padding-left:1em}
+.macro{color:#939;font-weight:bold}.notice{color:#c33;font-weight:bold}.replay{color:#099;font-weight:bold}.tag{color:#b80;font-weight:bold}"""
+
+HTML_INLINE = re.compile(f'{WIKI_LINK.pattern}|{EMPHASIS.pattern}')
+
+def static_link_href(target):
+    # Sites exported side by side with the default names link across communities
+    comm_name, page_file = link_target(target)
+    if comm_name is None:
+        return html_page_name(page_file)
+    return f'../{comm_name}_html/{html_page_name(page_file)}'
+
+def html_emphasis(text, link_href=static_link_href):
+    # Same markers as the terminal renderer, but paired into tags and closed at the end of the line
+    out = []
+    open_tags = []
+    pos = 0
+    for m in HTML_INLINE.finditer(text):
+        out.append(html.escape(text[pos:m.start()]))
+        pos = m.end()
+        if m.group(1) is not None:
+            out.append(f'<a href="{html.escape(link_href(m.group(1)))}">{html.escape(m.group(2) or m.group(1))}</a>')
+            continue
+        tag = 'strong' if len(m.group()) == 2 else 'em'
+        if open_tags and open_tags[-1] == tag:
+            out.append(f'</{open_tags.pop()}>')
+        else:
+            open_tags.append(tag)
+            out.append(f'<{tag}>')
+    out.append(html.escape(text[pos:]))
+    out.extend(f'</{tag}>' for tag in reversed(open_tags))
+    return ''.join(out)
+
+def tag_slug(tag):
+    return re.sub(r'[^\w.-]+', '_', tag.strip()) or '_'
+
+def html_page_name(page_file):
+    return page_file[:-3] + '.html' if page_file.endswith('.md') else page_file + '.html'
+
+def render_html_tokens(tokens, tag_prefix='tags/', link_href=static_link_href, version=None):
+    out = []
+    in_code = False
+    in_list = False
+    for kind, value in tokens:
+        if in_list and kind != 'bullet':
+            out.append('</ul>')
+            in_list = False
+        if kind == 'code':
+            if value.strip().startswith('```'):
+                out.append('</code></pre>' if in_code else '<pre><code>')
+                in_code = not in_code
+            else:
+                out.append(html.escape(value))
+            continue
+        if kind in ('h1', 'h2', 'h3'):
+            out.append(f'<{kind}>{html_emphasis(value, link_href)}</{kind}>')
+        elif kind == 'bullet':
+            if not in_list:
+                out.append('<ul>')
+                in_list = True
+            out.append(f'<li>{html_emphasis(value[2:], link_href)}</li>')
+        elif kind == 'quote':
+            out.append(f'<blockquote>{html_emphasis(value[2:], link_href)}</blockquote>')
+        elif kind == 'inline':
+            out.append('<p>' + ''.join(f'<code>{html.escape(part)}</code>' if i % 2 else html_emphasis(part, link_href)
+                                       for i, part in enumerate(value)) + '</p>')
+        elif kind == 'macro':
+            out.append(f'<p class="macro">[Macro: {html.escape(value)}]</p>')
+            output = run_macro(value, version)
+            if output:
+                out.append(f'<pre class="macro-output">{html.escape(output.rstrip())}</pre>')
+        elif kind == 'replay':
+            out.append(f'<p class="replay">[Edit Macro: {html.escape(value)}]</p>')
+        elif kind == 'include':
+            out.append(f'<p class="replay">[Include: {html.escape(value)}]</p>')
+        elif kind == 'notice':
+            out.append(f'<p class="notice">{html.escape(value)}</p>')
+        elif kind == 'tag':
+            out.append(f'<p class="tag"><a href="{tag_prefix}{tag_slug(value)}.html">[Tag: {html.escape(value)}]</a></p>')
+        elif kind == 'hr':
+            out.append('<hr>')
+        elif value.strip():
+            out.append(f'<p>{html_emphasis(value, link_href)}</p>')
+    if in_list:
+        out.append('</ul>')
+    if in_code:
+        out.append('</code></pre>')
+    return '\n'.join(out)
+
+def html_document(title, body, root=''):
+    return (f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>{html.escape(title)}</title>'
+            f'<link rel="stylesheet" href="{root}style.css"></head>\n<body>\n'
+            f'<nav><a href="{root}index.html">Index</a></nav>\n{body}\n</body></html>\n')
+
+def render_html_worker(comm, page_file, out_dir):
+    # Runs in a pool process; returns what the manifest and the tag pages need
+    start = time.perf_counter()
+    digest, tokens = page_tokens(os.path.join(comm, page_file), with_digest=True)
+    version, expanded, deps = expanded_tokens(comm, page_file)
+    body = render_html_tokens(expanded, version=version)
+    atomic_write(os.path.join(out_dir, html_page_name(page_file)), html_document(page_file, body), durable=False)
+    tags = list(dict.fromkeys(value.strip() for kind, value in tokens if kind == 'tag' and value.strip()))
+    # Stat stamps of included pages, so a later build re-renders this page when one of them changes
+    includes = {dep: include_stamp(dep) for dep, _ in deps[1:]}
+    if any(kind == 'replay' for kind, _ in tokens):
+        macros_path = os.path.join(comm, '_edit_macros.json')
+        includes[macros_path] = include_stamp(macros_path)
+    return digest, tags, includes, time.perf_counter() - start
+
+def include_stamp(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+@instrumented
+def export_html(comm, out_dir=None, workers=None, full=False):
+    out_dir = out_dir or f'{comm[1:]}_html'
+    os.makedirs(os.path.join(out_dir, 'tags'), exist_ok=True)
+    manifest_path = os.path.join(out_dir, '.firewiki-html.json')
+    previous = {'pages': {}}
+    if not full and os.path.exists(manifest_path):
+        previous = json.load(open(manifest_path))
+        if previous.get('renderer') != HTML_RENDERER_VERSION:
+            previous = {'pages': {}}
+
+    pages = list_pages(comm)
+    stale = []
+    for page_file in pages:
+        st = os.stat(os.path.join(comm, page_file))
+        old = previous['pages'].get(page_file)
+        if not (old and old['size'] == st.st_size and old['mtime_ns'] == st.st_mtime_ns
+                and all(include_stamp(dep) == stamp for dep, stamp in old.get('includes', {}).items())
+                and os.path.exists(os.path.join(out_dir, html_page_name(page_file)))):
+            stale.append((page_file, st))
+    removed = [p for p in previous['pages'] if p not in set(pages)]
+
+    manifest = {'renderer': HTML_RENDERER_VERSION, 'pages': dict(previous['pages'])}
+    dirty_tags = set()
+    timings = []
+    failures = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=forget_catalog_connections) as pool:
+        futures = {pool.submit(render_html_worker, comm, page_file, out_dir): (page_file, st) for page_file, st in stale}
+        for future in as_completed(futures):
+            page_file, st = futures[future]
+            try:
+                digest, tags, includes, elapsed = future.result()
+            except Exception as e:
+                failures[page_file] = str(e)
+                continue
+            old_tags = previous['pages'].get(page_file, {}).get('tags', [])
+            if page_file not in previous['pages'] or previous['pages'][page_file]['hash'] != digest:
+                dirty_tags.update(old_tags)
+                dirty_tags.update(tags)
+            elif old_tags != tags:
+                dirty_tags.update(old_tags)
+                dirty_tags.update(tags)
+            manifest['pages'][page_file] = {'hash': digest, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'tags': tags,
+                                            'includes': includes}
+            timings.append((elapsed, page_file))
+    for page_file in removed:
+        dirty_tags.update(manifest['pages'].pop(page_file).get('tags', []))
+        html_path = os.path.join(out_dir, html_page_name(page_file))
+        if os.path.exists(html_path):
+            os.remove(html_path)
+
+    # Tag pages and the index only depend on page names and tags, so only the affected ones are rebuilt
+    tag_pages = {}
+    for page_file, entry in manifest['pages'].items():
+        for tag in entry['tags']:
+            tag_pages.setdefault(tag, []).append(page_file)
+    for tag in dirty_tags:
+        tag_path = os.path.join(out_dir, 'tags', tag_slug(tag) + '.html')
+        if tag in tag_pages:
+            items = ''.join(f'<li><a href="../{html.escape(html_page_name(p))}">{html.escape(p)}</a></li>'
+                            for p in sorted(tag_pages[tag]))
+            atomic_write(tag_path, html_document(f'Tag: {tag}', f'<h1>Tag: {html.escape(tag)}</h1>\n<ul>{items}</ul>', '../'),
+                         durable=False)
+        elif os.path.exists(tag_path):
+            os.remove(tag_path)
+    if stale or removed or not os.path.exists(os.path.join(out_dir, 'index.html')):
+        meta = read_metadata(comm)
+        items = ''.join(f'<li><a href="{html.escape(html_page_name(p))}">{html.escape(p)}</a></li>' for p in sorted(manifest['pages']))
+        tags = ''.join(f'<li><a href="tags/{tag_slug(t)}.html">{html.escape(t)}</a> ({len(ps)})</li>' for t, ps in sorted(tag_pages.items()))
+        body = (f'<h1>{html.escape(meta.get("Name", comm[1:]))}</h1>\n<p>{html.escape(meta.get("Description", ""))}</p>\n'
+                f'<h2>Pages</h2>\n<ul>{items}</ul>\n<h2>Tags</h2>\n<ul>{tags}</ul>')
+        atomic_write(os.path.join(out_dir, 'index.html'), html_document(meta.get('Name', comm[1:]), body), durable=False)
+        atomic_write(os.path.join(out_dir, 'style.css'), HTML_STYLE, durable=False)
+    atomic_write(manifest_path, json.dumps(manifest), durable=False)
+
+    total = sum(elapsed for elapsed, _ in timings)
+    print(f'HTML export to {out_dir}: {len(timings)} pages rendered, {len(pages) - len(stale)} unchanged, '
+          f'{len(removed)} removed, {len(dirty_tags)} tag pages updated ({total * 1000:.0f} ms rendering).')
+    for elapsed, page_file in sorted(timings, reverse=True)[:5]:
+        print(f'  {elapsed * 1000:8.1f} ms  {page_file}')
+    for page_file, error in failures.items():
+        print(f'  failed {page_file}: {error}')
+    return manifest
+
+SERVER_CACHE_SIZE = 1024
+SERVER_IDLE_TIMEOUT = 15
+SERVER_MAX_BODY = 16 * 1024 * 1024
+
+def cached_page(comm, page_file):
+    # (mtime_ns, size, digest, content, {format: rendered bytes}); writes drop the entry via invalidate_render_cache
+    path = os.path.join(comm, page_file)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        response_cache.pop(path, None)
+        return None
+    entry = response_cache.get(path)
+    if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+        response_cache.move_to_end(path)
+        return entry
+    with open(path) as f:
+        content = f.read()
+    entry = (st.st_mtime_ns, st.st_size, content_digest(content), content, {})
+    response_cache[path] = entry
+    if len(response_cache) > SERVER_CACHE_SIZE:
+        response_cache.popitem(last=False)
+    return entry
+
+def server_link_href(target):
+    comm_name, page_file = link_target(target)
+    return f'{quote(page_file)}?format=html' if comm_name is None else f'/{quote(comm_name)}/{quote(page_file)}?format=html'
+
+def rendered_page(comm, page_file, entry, fmt, version, tokens):
+    # Kept per format and expansion version, so a change to an included page re-renders its includers
+    cached = entry[4].get(fmt)
+    if cached is None or cached[0] != version:
+        if fmt == 'html':
+            body = render_html_tokens(tokens, '/tags/', server_link_href, version)
+            cached = (version, html_document(f'{comm[1:]}/{page_file}', body, '/').encode())
+        else:
+            cached = (version, render_tokens(tokens, version).encode())
+        entry[4][fmt] = cached
+    return cached[1]
+
+def http_response(status, body=b'', content_type='application/json', etag=None):
+    if not isinstance(body, bytes):
+        body = json.dumps(body).encode() if content_type == 'application/json' else body.encode()
+    headers = {'Content-Type': f'{content_type}; charset=utf-8'}
+    if etag:
+        headers['ETag'] = f'"{etag}"'
+    return status, headers, body
+
+def etag_matches(headers, etag):
+    wanted = [tag.strip().removeprefix('W/').strip('"') for tag in headers.get('if-none-match', '').split(',')]
+    return '*' in wanted or etag in wanted
+
+async def serve_request(method, target, headers, body, pool, renderer):
+    url = urlsplit(target)
+    query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+    parts = [unquote(part) for part in url.path.split('/') if part]
+    loop = asyncio.get_running_loop()
+    reading = method in ('GET', 'HEAD')
+
+    if reading and (not parts or parts == ['index.html']):
+        return http_response(200, [comm[1:] for comm in load_communities()])
+    if reading and parts == ['style.css']:
+        return http_response(200, HTML_STYLE, 'text/css')
+    if reading and len(parts) == 2 and parts[0] == 'tags':
+        slug = parts[1].removesuffix('.html')
+        tags = await loop.run_in_executor(None, global_tag_index)
+        found = [f'{comm[1:]}/{page_file}' for tag, pages in tags.items() if tag == slug or tag_slug(tag) == slug
+                 for comm, page_file in pages]
+        return http_response(200, found)
+
+    if not parts:
+        return http_response(405, {'error': 'method not allowed'})
+    comm = community_path(parts[0])
+    if '/' in parts[0] or comm not in load_communities():
+        return http_response(404, {'error': 'community not found'})
+    if len(parts) == 1:
+        if not reading:
+            return http_response(405, {'error': 'method not allowed'})
+        pages = await loop.run_in_executor(None, list_pages, comm)
+        return http_response(200, {'metadata': read_metadata(comm), 'pages': pages})
+    if parts[1] == 'search' and len(parts) == 2:
+        limit = query.get('limit', '20')
+        if not limit.isdigit():
+            return http_response(400, {'error': 'limit must be a non-negative integer'})
+        results = await loop.run_in_executor(pool, search_pages, comm, query.get('q', ''), int(limit))
+        return http_response(200, [{'page': page_file, 'score': score, 'lines': lines} for score, page_file, lines in results])
+
+    page_file = page_name(parts[1])
+    if '/' in page_file or '\0' in page_file or page_file.startswith(('.', '_')):
+        return http_response(404, {'error': 'page not found'})
+
+    if len(parts) == 2 and method == 'PUT':
+        if_match = headers.get('if-match')
+        expected = None if if_match in (None, '*') else if_match.strip().strip('"')
+        existed = os.path.exists(os.path.join(comm, page_file))
+        try:
+            content = body.decode('utf-8')
+            await loop.run_in_executor(pool, put_page, comm, page_file, content, expected)
+        except UnicodeDecodeError:
+            return http_response(400, {'error': 'body must be UTF-8'})
+        except PageConflictError as conflict:
+            return http_response(412, {'error': str(conflict)}, etag=page_digest(conflict.current) or None)
+        finally:
+            # The write ran in another process; its mtime can land in the same tick as our cached copy
+            await loop.run_in_executor(renderer, invalidate_render_cache, os.path.join(comm, page_file))
+        return http_response(200 if existed else 201, {'page': page_file}, etag=content_digest(content))
+
+    entry = await loop.run_in_executor(None, cached_page, comm, page_file)
+    if entry is None:
+        return http_response(404, {'error': 'page not found'})
+
+    if len(parts) == 2 and reading:
+        fmt = query.get('format', 'raw')
+        if fmt not in ('raw', 'html', 'ansi'):
+            return http_response(400, {'error': 'format must be raw, html or ansi'})
+        if fmt == 'raw':
+            etag = entry[2]
+        else:
+            version, tokens, _ = await loop.run_in_executor(renderer, expanded_tokens, comm, page_file)
+            etag = f'{version}-{fmt}'
+        if etag_matches(headers, etag):
+            return 304, {'ETag': f'"{etag}"'}, b''
+        if fmt == 'raw':
+            return http_response(200, entry[3], 'text/markdown', etag)
+        body = await loop.run_in_executor(renderer, rendered_page, comm, page_file, entry, fmt, version, tokens)
+        return http_response(200, body, 'text/html' if fmt == 'html' else 'text/plain', etag)
+
+    if parts[2] == 'backlinks' and reading and len(parts) == 3:
+        found = await loop.run_in_executor(None, pages_linking_to, comm, page_file)
+        return http_response(200, [f'{other[1:]}/{source}' for other, source in found])
+
+    if parts[2] == 'diff' and reading and len(parts) in (4, 5) and all(p.isdigit() for p in parts[3:]):
+        versions = await loop.run_in_executor(None, load_page_versions, comm, page_file)
+        numbers = [int(p) for p in parts[3:]] + [0]
+        if not (1 <= numbers[0] <= len(versions) and 0 <= numbers[1] <= len(versions)):
+            return http_response(404, {'error': 'version not found'})
+        # Diffs are CPU bound, so they go to the process pool like searches
+        text = await loop.run_in_executor(pool, diff_versions_text, comm, page_file, versions[-numbers[0]],
+                                          versions[-numbers[1]] if numbers[1] else None)
+        if text is None:
+            return http_response(404, {'error': 'version file not found'})
+        return http_response(200, text, 'text/plain')
+
+    if parts[2] in ('history', 'restore'):
+        versions = await loop.run_in_executor(None, load_page_versions, comm, page_file)
+        if len(parts) == 3 and parts[2] == 'history' and reading:
+            return http_response(200, [{'number': i + 1, 'timestamp': version['timestamp'], 'operation': version['operation'],
+                                        'hash': version.get('blob') or version['hash']}
+                                       for i, version in enumerate(reversed(versions))])
+        if len(parts) == 4 and parts[3].isdigit():
+            number = int(parts[3])
+            if not 1 <= number <= len(versions):
+                return http_response(404, {'error': 'version not found'})
+            version = versions[-number]
+            if parts[2] == 'history' and reading:
+                content = await loop.run_in_executor(None, read_version, comm, page_file, version)
+                if content is None:
+                    return http_response(404, {'error': 'version file not found'})
+                return http_response(200, content, 'text/markdown', content_digest(content))
+            if parts[2] == 'restore' and method == 'POST':
+                try:
+                    content = await loop.run_in_executor(pool, restore_page, comm, page_file, version)
+                finally:
+                    await loop.run_in_executor(renderer, invalidate_render_cache, os.path.join(comm, page_file))
+                if content is None:
+                    return http_response(404, {'error': 'version file not found'})
+                return http_response(200, {'page': page_file, 'restored': number}, etag=content_digest(content))
+    return http_response(405 if len(parts) == 2 else 404, {'error': 'no such resource'})
+
+async def handle_http(reader, writer, pool, renderer):
+    # One coroutine per connection; requests on a keep-alive connection are served in order
+    try:
+        while True:
+            try:
+                request_line = await asyncio.wait_for(reader.readline(), SERVER_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                break
+            if not request_line.strip():
+                break
+            try:
+                method, target, version = request_line.decode('latin-1').split()
+            except ValueError:
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            connection = headers.get('connection', '').lower()
+            keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+            length = headers.get('content-length') or '0'
+            if not length.isdigit():
+                status, response_headers, body = http_response(400, {'error': 'bad Content-Length'})
+                keep_alive = False
+            elif int(length) > SERVER_MAX_BODY:
+                status, response_headers, body = http_response(413, {'error': 'request body too large'})
+                keep_alive = False
+            else:
+                body = await reader.readexactly(int(length)) if int(length) else b''
+                try:
+                    status, response_headers, body = await serve_request(method, target, headers, body, pool, renderer)
+                except Exception as e:
+                    status, response_headers, body = http_response(500, {'error': str(e)})
+            response_headers['Content-Length'] = str(len(body))
+            response_headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+            head = f'HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n'
+            head += ''.join(f'{name}: {value}\r\n' for name, value in response_headers.items())
+            writer.write(head.encode('latin-1') + b'\r\n' + (b'' if method == 'HEAD' else body))
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def run_server(host, port, workers=None):
+    # Writes, searches and diffs go to a small process pool; file and index reads to the loop's default
+    # thread pool. Expansion and rendering (macros included) run on one thread that owns the render caches,
+    # so nothing slow ever runs on the loop itself
+    with ProcessPoolExecutor(max_workers=workers, initializer=forget_catalog_connections) as pool, \
+            ThreadPoolExecutor(max_workers=1) as renderer:
+        server = await asyncio.start_server(lambda r, w: handle_http(r, w, pool, renderer), host, port, backlog=1024)
+        print(f'Serving FireWiki on http://{host}:{port}/')
+        async with server:
+            await server.serve_forever()
+
+def serve(host='127.0.0.1', port=8080, workers=None):
+    try:
+        asyncio.run(run_server(host, port, workers))
+    except KeyboardInterrupt:
+        pass
+
+PACK_MAGIC = b'FWPACK1\n'
+PACK_FOOTER = struct.Struct('<QQ8s')
+
+class CommunityPack:
+    # Read-only view of a .fwpack file: compressed pages, version blobs and the journal in one file,
+    # located through a JSON index at the end and read through mmap without loading the rest
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < len(PACK_MAGIC) + PACK_FOOTER.size or self.map[:len(PACK_MAGIC)] != PACK_MAGIC:
+            raise ValueError(f'{path} is not a FireWiki pack')
+        index_at, index_length, magic = PACK_FOOTER.unpack_from(self.map, len(self.map) - PACK_FOOTER.size)
+        if magic != PACK_MAGIC:
+            raise ValueError(f'{path} is truncated')
+        self.index = json.loads(self.map[index_at:index_at + index_length])
+        self.versions = None
+
+    def chunk(self, ref):
+        return self.map[ref[0]:ref[0] + ref[1]]
+
+    def pages(self):
+        return sorted(self.index['pages'])
+
+    def read_page(self, page_file):
+        ref = self.index['pages'].get(page_file)
+        return zlib.decompress(self.chunk(ref)).decode() if ref else None
+
+    def page_digest(self, page_file):
+        ref = self.index['pages'].get(page_file)
+        return ref[2] if ref else ''
+
+    def load_page_versions(self, page_file):
+        if self.versions is None:
+            self.versions = {}
+            for line in zlib.decompress(self.chunk(self.index['journal'])).splitlines():
+                entry = json.loads(line)
+                self.versions.setdefault(entry['page'], []).append(entry)
+        return self.versions.get(page_file, [])
+
+    def read_version(self, version):
+        if version.get('blob') not in self.index['blobs']:
+            return None
+        return resolve_blob(lambda digest: json.loads(zlib.decompress(self.chunk(self.index['blobs'][digest]))), version['blob'])
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+@instrumented
+def pack_community(comm, filename=None):
+    filename = filename or f'{comm[1:]}.fwpack'
+    migrate_version_log(comm)
+    index = {'metadata': read_metadata(comm), 'edit_macros': load_edit_macros(comm), 'pages': {}, 'blobs': {}}
+    with journal_lock(comm):
+        entries = load_version_journal(comm)
+        if any('blob' not in entry for entry in entries):
+            # Loose timestamped copies from before the blob store are converted first
+            pack_journal_versions(comm)
+            entries = load_version_journal(comm)
+        with atomic_open(filename, 'wb') as f:
+            offset = 0
+
+            def put(data):
+                nonlocal offset
+                f.write(data)
+                offset += len(data)
+                return [offset - len(data), len(data)]
+
+            put(PACK_MAGIC)
+            for page_file in list_pages(comm):
+                content = get_page(comm, page_file)
+                if content is not None:
+                    index['pages'][page_file] = put(zlib.compress(content.encode())) + [content_digest(content)]
+            # Blobs are already compressed records and go in byte for byte, delta bases included
+            for digest in sorted(reachable_blobs(comm, entries)):
+                path = blob_path(comm, digest)
+                if os.path.exists(path):
+                    with open(path, 'rb') as blob:
+                        index['blobs'][digest] = put(blob.read())
+            index['journal'] = put(zlib.compress(''.join(json.dumps(entry) + '\n' for entry in entries).encode()))
+            index_bytes = json.dumps(index).encode()
+            index_at = offset
+            put(index_bytes)
+            put(PACK_FOOTER.pack(index_at, len(index_bytes), PACK_MAGIC))
+    print(f"Packed {len(index['pages'])} pages and {len(entries)} versions into {filename} ({os.path.getsize(filename)} bytes).")
+    return filename
+
+PACK_DIGEST = re.compile(r'[0-9a-f]{64}')
+
+def valid_pack_page(page_file):
+    # Names come from a file that may have been shared, so they must stay inside the community directory
+    return (isinstance(page_file, str) and page_file.endswith('.md') and '/' not in page_file and '\\' not in page_file
+            and not page_file.startswith(('.', '_')))
+
+def pack_problem(pack, name, entries):
+    if not isinstance(name, str) or not name.strip() or name.startswith('.') or '/' in name or '\\' in name:
+        return f'invalid community name {name!r}'
+    for page_file in list(pack.index['pages']) + [entry.get('page') for entry in entries]:
+        if not valid_pack_page(page_file):
+            return f'invalid page name {page_file!r}'
+    for digest in pack.index['blobs']:
+        if not PACK_DIGEST.fullmatch(digest):
+            return f'invalid blob digest {digest!r}'
+    return None
+
+@instrumented
+def unpack_community(pack_path, name=None):
+    pack = CommunityPack(pack_path)
+    try:
+        name = name or pack.index['metadata'].get('Name') or os.path.basename(pack_path).rsplit('.', 1)[0]
+        entries = [json.loads(line) for line in zlib.decompress(pack.chunk(pack.index['journal'])).splitlines()]
+        problem = pack_problem(pack, name, entries)
+        if problem:
+            print(f'Refusing to unpack {pack_path}: {problem}.')
+            return None
+        comm = community_path(name)
+        if os.path.exists(comm):
+            print(f'Community {name} already exists.')
+            return None
+        os.makedirs(os.path.join(comm, '_versions'))
+        with durability_batch():
+            atomic_write(os.path.join(comm, '_metadata.json'), json.dumps(dict(pack.index['metadata'], Name=name)))
+            save_edit_macros(comm, pack.index['edit_macros'])
+            for page_file in pack.pages():
+                atomic_write(os.path.join(comm, page_file), pack.read_page(page_file))
+            for digest, ref in pack.index['blobs'].items():
+                os.makedirs(os.path.dirname(blob_path(comm, digest)), exist_ok=True)
+                atomic_write(blob_path(comm, digest), bytes(pack.chunk(ref)))
+            write_version_journal(comm, entries)
+    finally:
+        pack.close()
+    print(f'Unpacked {len(pack.index["pages"])} pages and {len(entries)} versions into {name}.')
+    return comm
+
+def render_pack_page(pack, page_file):
+    # Pages are shown as stored: @include and @replay need the loose layout and appear as markers
+    content = pack.read_page(page_file)
+    return render_tokens(markdown_tokens(content.split('\n')), pack.page_digest(page_file))
+
+def browse_pack(path=None):
+    path = path or input('Pack file: ').strip()
+    try:
+        pack = CommunityPack(path)
+    except (OSError, ValueError) as e:
+        print(f'Cannot open pack: {e}')
+        return
+    try:
+        while True:
+            pages = pack.pages()
+            print(ansi(f"{pack.index['metadata'].get('Name', path)} (read-only pack)", '1;31'))
+            for i, p in enumerate(pages):
+                print(f'{i+1}. {p}')
+            choice = input("Select page to view (number or name, Enter to go back): ").strip()
+            if not choice:
+                break
+            if choice.isdigit() and 0 < int(choice) <= len(pages):
+                page_file = pages[int(choice)-1]
+            elif page_name(choice) in pages:
+                page_file = page_name(choice)
+            else:
+                print("Page not found")
+                continue
+            print(f'--- {page_file} ---')
+            print(render_pack_page(pack, page_file))
+            versions = pack.load_page_versions(page_file)
+            for i, version in enumerate(reversed(versions)):
+                print(f"{i+1}. {version['timestamp']} - {version['operation']} - Hash: {version['hash']}")
+            choice = input("Version to view (number, Enter to go back): ").strip()
+            if choice.isdigit() and 1 <= int(choice) <= len(versions):
+                content = pack.read_version(versions[-int(choice)])
+                print(render_markdown(content) if content is not None else "Version file not found.")
+                input("Press any key to continue...")
+    finally:
+        pack.close()
 
 def manage_community():
     communities = load_communities()
@@ -469,6 +3313,13 @@ def manage_community():
         "Restore Version (R)",
         "Replay Macro (m)",
         "Export POSIX (x)",
+        "Pack Versions (p)",
+        "Search Pages (s)",
+        "Batch Replay Macro (b)",
+        "Export HTML (w)",
+        "Collect Garbage (g)",
+        "Link Report (l)",
+        "Write Pack File (a)",
         "Back (q)"
     ]
     
@@ -551,6 +3402,7 @@ def manage_community():
                     elif key2 == '\r' or key2 == '\n':
                         page_file = pages[page_selection]
                         view_version_history(comm, page_file)
+                        compare_versions(comm, page_file)
                         input("Press any key to continue...")
                         break
                     elif key2 == 'q':
@@ -617,7 +3469,28 @@ def manage_community():
             elif current_selection == 7:  # Export POSIX
                 export_posix(comm)
                 input("Press any key to continue...")
-            elif current_selection == 8:  # Back
+            elif current_selection == 8:  # Pack Versions
+                pack_versions(comm)
+                input("Press any key to continue...")
+            elif current_selection == 9:  # Search Pages
+                search_community(comm)
+                input("Press any key to continue...")
+            elif current_selection == 10:  # Batch Replay Macro
+                batch_replay_prompt(comm)
+                input("Press any key to continue...")
+            elif current_selection == 11:  # Export HTML
+                export_html(comm)
+                input("Press any key to continue...")
+            elif current_selection == 12:  # Collect Garbage
+                collect_versions_prompt(comm)
+                input("Press any key to continue...")
+            elif current_selection == 13:  # Link Report
+                link_report(comm)
+                input("Press any key to continue...")
+            elif current_selection == 14:  # Write Pack File
+                pack_community(comm)
+                input("Press any key to continue...")
+            elif current_selection == 15:  # Back
                 break
         elif key == 'q':  # Quit
             break
@@ -684,6 +3557,7 @@ def manage_community():
                 elif key2 == '\r' or key2 == '\n':
                     page_file = pages[page_selection]
                     view_version_history(comm, page_file)
+                    compare_versions(comm, page_file)
                     input("Press any key to continue...")
                     break
                 elif key2 == 'q':
@@ -750,6 +3624,284 @@ def manage_community():
         elif key == 'x':  # Quick key for Export POSIX
             export_posix(comm)
             input("Press any key to continue...")
+        elif key == 'p':  # Quick key for Pack Versions
+            pack_versions(comm)
+            input("Press any key to continue...")
+        elif key == 's':  # Quick key for Search Pages
+            search_community(comm)
+            input("Press any key to continue...")
+        elif key == 'b':  # Quick key for Batch Replay Macro
+            batch_replay_prompt(comm)
+            input("Press any key to continue...")
+        elif key == 'w':  # Quick key for Export HTML
+            export_html(comm)
+            input("Press any key to continue...")
+        elif key == 'g':  # Quick key for Collect Garbage
+            collect_versions_prompt(comm)
+            input("Press any key to continue...")
+        elif key == 'l':  # Quick key for Link Report
+            link_report(comm)
+            input("Press any key to continue...")
+        elif key == 'a':  # Quick key for Write Pack File
+            pack_community(comm)
+            input("Press any key to continue...")
+
+def cli_page(args):
+    comm = community_path(args.community)
+    page_file = page_name(args.page)
+    if not os.path.isdir(comm):
+        print(f'Community not found: {args.community}', file=sys.stderr)
+        return 1
+    if args.action == 'put':
+        content = open(args.file).read() if args.file else sys.stdin.read()
+        try:
+            put_page(comm, page_file, content, args.expect)
+        except PageConflictError as conflict:
+            print(f'Conflict: {conflict} (current sha256 {page_digest(conflict.current) or "none"})', file=sys.stderr)
+            return 2
+        return 0
+    if get_page(comm, page_file) is None:
+        print(f'Page not found: {page_file}', file=sys.stderr)
+        return 1
+    if args.action == 'get':
+        sys.stdout.write(get_page(comm, page_file))
+    elif args.action == 'render':
+        print(render_page(comm, page_file))
+    elif args.action == 'history':
+        for i, version in enumerate(reversed(load_page_versions(comm, page_file))):
+            print(f"{i+1}. {version['timestamp']} - {version['operation']} - Hash: {version['hash']}")
+    elif args.action == 'apply-replays':
+        if not apply_replays(comm, page_file):
+            print(f'No @replay lines in {page_file}.', file=sys.stderr)
+    elif args.action == 'backlinks':
+        for other, source in pages_linking_to(comm, page_file):
+            print(f'{other[1:]}/{source}')
+    elif args.action == 'diff':
+        versions = load_page_versions(comm, page_file)
+        if not (1 <= args.old <= len(versions) and 0 <= args.new <= len(versions)):
+            print("Invalid selection.", file=sys.stderr)
+            return 1
+        lines = diff_versions(comm, page_file, versions[-args.old], versions[-args.new] if args.new else None, args.context)
+        if lines is None:
+            print("Version file not found.", file=sys.stderr)
+            return 1
+        for line in lines:
+            print(line)
+    elif args.action == 'restore':
+        versions = load_page_versions(comm, page_file)
+        if not 1 <= args.number <= len(versions):
+            print("Invalid selection.", file=sys.stderr)
+            return 1
+        if args.preview:
+            lines = diff_versions(comm, page_file, None, versions[-args.number])
+            for line in lines or []:
+                print(line)
+            return 0 if lines is not None else 1
+        if restore_page(comm, page_file, versions[-args.number]) is None:
+            print("Version file not found.", file=sys.stderr)
+            return 1
+    return 0
+
+def cli_community(args):
+    if args.action == 'create':
+        save_community_metadata(args.name, args.genre, args.description, args.age)
+    elif args.action == 'list':
+        for comm in load_communities():
+            print(comm[1:])
+    else:
+        comm = community_path(args.name)
+        if not os.path.isdir(comm):
+            print(f'Community not found: {args.name}', file=sys.stderr)
+            return 1
+        if args.action == 'export':
+            export_posix(comm, args.pages, args.output)
+        elif args.action == 'html':
+            export_html(comm, args.output, args.workers, args.full)
+        elif args.action == 'pack-versions':
+            pack_versions(comm)
+        elif args.action == 'orphans':
+            for page_file in orphan_pages(comm):
+                print(page_file)
+        elif args.action == 'gc':
+            if args.background:
+                collect_versions_background(comm, args.steps)
+            else:
+                collect_versions(comm, args.steps, args.dry_run)
+        elif args.action == 'retention':
+            policy = {} if args.clear else retention_policy(comm)
+            changes = {key: getattr(args, key) for key in RETENTION_KEYS if getattr(args, key) is not None}
+            if changes or args.clear:
+                save_retention_policy(comm, dict(policy, **changes))
+            print(json.dumps(retention_policy(comm)))
+        elif args.action == 'search':
+            for score, page_file, lines in search_pages(comm, args.query, args.limit):
+                print(f"{page_file}\t{score:.2f}\t{','.join(map(str, lines))}")
+        elif args.action == 'replay':
+            result = batch_replay_macro(comm, args.macro, args.pattern, args.workers)
+            return 0 if result and not result[1] else 1
+        elif args.action == 'import':
+            import_tree(comm, args.source, args.batch_size)
+    return 0
+
+def cli_tag(args):
+    for comm, page_file in global_tag_index().get(args.tag, []):
+        print(f'{comm[1:]}/{page_file}')
+    return 0
+
+def cli_pack(args):
+    if args.action == 'create':
+        comm = community_path(args.name)
+        if not os.path.isdir(comm):
+            print(f'Community not found: {args.name}', file=sys.stderr)
+            return 1
+        pack_community(comm, args.output)
+        return 0
+    if args.action == 'unpack':
+        return 0 if unpack_community(args.file, args.name) else 1
+    if args.action == 'browse':
+        browse_pack(args.file)
+        return 0
+    try:
+        pack = CommunityPack(args.file)
+    except (OSError, ValueError) as e:
+        print(f'Cannot open pack: {e}', file=sys.stderr)
+        return 1
+    try:
+        if args.action == 'list':
+            for page_file in pack.pages():
+                print(page_file)
+            return 0
+        page_file = page_name(args.page)
+        if pack.read_page(page_file) is None:
+            print(f'Page not found: {page_file}', file=sys.stderr)
+            return 1
+        versions = pack.load_page_versions(page_file)
+        if args.action == 'get' and args.version:
+            if not 1 <= args.version <= len(versions):
+                print("Invalid selection.", file=sys.stderr)
+                return 1
+            sys.stdout.write(pack.read_version(versions[-args.version]) or '')
+        elif args.action == 'get':
+            sys.stdout.write(pack.read_page(page_file))
+        elif args.action == 'render':
+            print(render_pack_page(pack, page_file))
+        elif args.action == 'history':
+            for i, version in enumerate(reversed(versions)):
+                print(f"{i+1}. {version['timestamp']} - {version['operation']} - Hash: {version['hash']}")
+    finally:
+        pack.close()
+    return 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='firewiki', description='FireWiki terminal wiki (run without arguments for the interactive menu)')
+    parser.add_argument('--metrics', action='store_true', help='record per-operation timings and I/O (same as FIREWIKI_METRICS=1)')
+    parser.add_argument('--durability', choices=['fsync', 'batch', 'none'],
+                        help='fsync every write, group fsyncs per batch, or skip fsync (same as FIREWIKI_DURABILITY)')
+    groups = parser.add_subparsers(dest='group', required=True)
+
+    page = groups.add_parser('page', help='read and write pages')
+    page_actions = page.add_subparsers(dest='action', required=True)
+    for action in ('put', 'get', 'render', 'history', 'restore', 'diff', 'backlinks', 'apply-replays'):
+        sub = page_actions.add_parser(action)
+        sub.add_argument('community')
+        sub.add_argument('page')
+        if action == 'put':
+            sub.add_argument('--file', help='read content from a file instead of stdin')
+            sub.add_argument('--expect', help='only save if the current page has this sha256 (empty string: page must not exist)')
+        elif action == 'restore':
+            sub.add_argument('number', type=int, help='version number as shown by history (1 = newest)')
+            sub.add_argument('--preview', action='store_true', help='print the diff against the current page instead of restoring')
+        elif action == 'diff':
+            sub.add_argument('old', type=int, help='version number as shown by history (1 = newest)')
+            sub.add_argument('new', type=int, nargs='?', default=0, help='version number to compare with (default: the current page)')
+            sub.add_argument('--context', type=int, default=DIFF_CONTEXT)
+    page.set_defaults(func=cli_page)
+
+    community = groups.add_parser('community', help='manage communities')
+    community_actions = community.add_subparsers(dest='action', required=True)
+    create = community_actions.add_parser('create')
+    create.add_argument('name')
+    create.add_argument('--genre')
+    create.add_argument('--description')
+    create.add_argument('--age')
+    community_actions.add_parser('list')
+    community_actions.add_parser('orphans', help='list pages nothing links to').add_argument('name')
+    community_actions.add_parser('pack-versions').add_argument('name')
+    gc = community_actions.add_parser('gc', help='expire versions per the retention policy and delete unreferenced blobs')
+    gc.add_argument('name')
+    gc.add_argument('--steps', type=int, help='only sweep this many of the 256 object directories, resuming next run')
+    gc.add_argument('--dry-run', action='store_true', help='report what would be reclaimed without deleting')
+    gc.add_argument('--background', action='store_true', help='run detached at low priority')
+    retention = community_actions.add_parser('retention', help='show or change the version retention policy')
+    retention.add_argument('name')
+    for key in RETENTION_KEYS:
+        retention.add_argument('--' + key.replace('_', '-'), type=int)
+    retention.add_argument('--clear', action='store_true', help='keep every version again')
+    site = community_actions.add_parser('html', help='render the community to a static HTML site')
+    site.add_argument('name')
+    site.add_argument('--output', help='output directory (default: <name>_html)')
+    site.add_argument('--workers', type=int)
+    site.add_argument('--full', action='store_true', help='ignore the previous build and render everything')
+    export = community_actions.add_parser('export', help='write a self-contained interactive POSIX script')
+    export.add_argument('name')
+    export.add_argument('--pages', help='only export pages matching this glob or tag:<name>')
+    export.add_argument('--output', help='script path (default: <name>.sh)')
+    search = community_actions.add_parser('search')
+    search.add_argument('name')
+    search.add_argument('query')
+    search.add_argument('--limit', type=int, default=20)
+    replay = community_actions.add_parser('replay', help='apply an edit macro to every matching page')
+    replay.add_argument('name')
+    replay.add_argument('macro')
+    replay.add_argument('pattern', help='page glob or tag:<name>')
+    replay.add_argument('--workers', type=int)
+    bulk = community_actions.add_parser('import', help='import a directory tree or tar archive of .md files')
+    bulk.add_argument('name')
+    bulk.add_argument('source')
+    bulk.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+    community.set_defaults(func=cli_community)
+
+    tag = groups.add_parser('tag', help='list pages carrying a tag across all communities')
+    tag.add_argument('tag')
+    tag.set_defaults(func=cli_tag)
+
+    pack = groups.add_parser('pack', help='single-file community archives')
+    pack_actions = pack.add_subparsers(dest='action', required=True)
+    create_pack = pack_actions.add_parser('create', help='write a community to a .fwpack file')
+    create_pack.add_argument('name')
+    create_pack.add_argument('--output', help='pack path (default: <name>.fwpack)')
+    unpack = pack_actions.add_parser('unpack', help='restore a pack as a regular community directory')
+    unpack.add_argument('file')
+    unpack.add_argument('--name', help='community name (default: the name stored in the pack)')
+    pack_actions.add_parser('browse', help='view pages and history from a pack, read-only').add_argument('file')
+    pack_actions.add_parser('list').add_argument('file')
+    for action in ('get', 'render', 'history'):
+        sub = pack_actions.add_parser(action)
+        sub.add_argument('file')
+        sub.add_argument('page')
+        if action == 'get':
+            sub.add_argument('--version', type=int, help='version number as shown by history (1 = newest)')
+    pack.set_defaults(func=cli_pack)
+
+    server = groups.add_parser('serve', help='serve communities over HTTP')
+    server.add_argument('--host', default='127.0.0.1')
+    server.add_argument('--port', type=int, default=8080)
+    server.add_argument('--workers', type=int, help='processes for writes and searches')
+    server.set_defaults(func=lambda args: serve(args.host, args.port, args.workers) or 0)
+
+    metrics = groups.add_parser('metrics', help='report recorded operation metrics')
+    metrics.add_argument('action', choices=['summary'])
+    metrics.set_defaults(func=lambda args: metrics_summary() or 0)
+    return parser
+
+def cli(argv=None):
+    args = build_parser().parse_args(argv)
+    global DURABILITY
+    if args.metrics:
+        enable_metrics()
+    if args.durability:
+        DURABILITY = args.durability
+    return args.func(args)
 
 def main():
     while True:
@@ -762,6 +3914,8 @@ def main():
             "Delete Community (d)",
             "Rename Community (r)",
             "Manage Community (m)",
+            "Find Tag (t)",
+            "Open Pack (o)",
             "Exit (q)"
         ]
         
@@ -797,7 +3951,14 @@ def main():
                 elif current_selection == 3:  # Manage Community
                     manage_community()
                     break
-                elif current_selection == 4:  # Exit
+                elif current_selection == 4:  # Find Tag
+                    find_tag()
+                    input("Press any key to continue...")
+                    break
+                elif current_selection == 5:  # Open Pack
+                    browse_pack()
+                    break
+                elif current_selection == 6:  # Exit
                     sys.exit()
             elif key == 'q':  # Quit
                 sys.exit()
@@ -816,6 +3977,19 @@ def main():
             elif key == 'm':  # Quick key for Manage Community
                 manage_community()
                 break
+            elif key == 't':  # Quick key for Find Tag
+                find_tag()
+                input("Press any key to continue...")
+                break
+            elif key == 'o':  # Quick key for Open Pack
+                browse_pack()
+                break
+
+if METRICS_ENABLED:
+    enable_metrics()
+load_macro_plugins()
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(cli())
     main()